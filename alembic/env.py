@@ -21,6 +21,7 @@ if config.config_file_name is not None:
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from app.models.user import Base
+import app.models.game  # registers the game history tables
 target_metadata = Base.metadata
 
 # other values from the config, defined by the needs of env.py,
@@ -0,0 +1,59 @@
+"""create game history tables
+
+Revision ID: 9c1f4e27b3d5
+Revises: 4682359fee18
+Create Date: 2026-10-18 19:20:41.517302
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c1f4e27b3d5'
+down_revision: Union[str, None] = '4682359fee18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('games',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('spy', sa.String(length=50), nullable=True),
+    sa.Column('location', sa.String(length=100), nullable=True),
+    sa.Column('players', sa.JSON(), nullable=True),
+    sa.Column('outcome', sa.String(length=32), nullable=True),
+    sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('ended_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_games_outcome'), 'games', ['outcome'], unique=False)
+    op.create_index(op.f('ix_games_ended_at'), 'games', ['ended_at'], unique=False)
+    op.create_table('rounds',
+    sa.Column('game_id', sa.String(length=36), nullable=False),
+    sa.Column('number', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('questions', sa.JSON(), nullable=True),
+    sa.Column('eliminated', sa.String(length=50), nullable=True),
+    sa.Column('ended_at', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('game_id', 'number')
+    )
+    op.create_table('votes',
+    sa.Column('game_id', sa.String(length=36), nullable=False),
+    sa.Column('round', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('ballot', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('voter', sa.String(length=50), nullable=False),
+    sa.Column('voted_for', sa.String(length=50), nullable=True),
+    sa.PrimaryKeyConstraint('game_id', 'round', 'ballot', 'voter')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('votes')
+    op.drop_table('rounds')
+    op.drop_index(op.f('ix_games_ended_at'), table_name='games')
+    op.drop_index(op.f('ix_games_outcome'), table_name='games')
+    op.drop_table('games')
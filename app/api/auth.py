@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from app.schemas.auth import UserCreate, Token, UserLogin, LoginResponse
 from app.models.user import User
-from app.services.auth import hash_password, create_access_token, verify_password
+from app.services.auth import hash_password, create_access_token, verify_and_update_password, invalidate_user
+from app.services.ratelimit import rate_limiter
 from app.database import async_session
+from app.core.log import get_logger
 from sqlalchemy.future import select
 
 router = APIRouter(prefix="/auth")
+log = get_logger("auth")
 
 @router.post("/register", response_model=Token)
 async def register(user: UserCreate):
@@ -13,22 +16,37 @@ async def register(user: UserCreate):
         result = await session.execute(select(User).where(User.username == user.username))
         if result.scalars().first():
             raise HTTPException(status_code=400, detail="Username exists")
-        hashed = hash_password(user.password)
+        hashed = await hash_password(user.password)
         db_user = User(username=user.username, email=user.email, hashed_password=hashed)
         session.add(db_user)
         await session.commit()
+        invalidate_user(user.username)
         token = create_access_token(data={"sub": user.username})
         return {"access_token": token, "token_type": "bearer", "username": user.username}
 
 @router.post("/login", response_model=LoginResponse)
-async def login(user: UserLogin):
+async def login(user: UserLogin, request: Request):
+    # Ahead of the database lookup and bcrypt. Failures count per address and account together, so guessing
+    # at an account is slowed down without anyone elsewhere being able to lock its owner out.
+    client = request.client.host if request.client else ""
+    failures = f"{client}:{user.username}"
+    rate_limiter.check("login", client)
+    rate_limiter.check("login_failed", failures, spend=False)
     async with async_session() as session:
         result = await session.execute(select(User).where(User.username == user.username))
         db_user = result.scalars().first()
-        if not db_user or not verify_password(user.password, db_user.hashed_password):
+        if not db_user:
+            rate_limiter.allow("login_failed", failures)
             raise HTTPException(status_code=400, detail="Invalid credentials")
+        valid, new_hash = await verify_and_update_password(user.password, db_user.hashed_password)
+        if not valid:
+            rate_limiter.allow("login_failed", failures)
+            raise HTTPException(status_code=400, detail="Invalid credentials")
+        if new_hash:
+            db_user.hashed_password = new_hash
+            await session.commit()
         token = create_access_token(data={"sub": db_user.username})
-        print(db_user.username)
+        log.debug("Logged in", extra={"username": db_user.username})
         return {
             "access_token": token,
             "token_type": "bearer",
@@ -1,22 +1,42 @@
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
-from jose import jwt
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect
+from app.core import codec
+from app.core.codec import Frame
 from app.core.config import get_settings
-from app.redis import redis_client
-from app.services.auth import get_current_user
-from app.services.game import add_user_to_pool, start_turn, process_votes
-from typing import Dict
-import json
+from app.core.keys import room_channel, user_channel
+from app.core.log import get_logger, bind_context
+from app.core.metrics import WS_OPEN, WS_MESSAGE_SECONDS
+from app.services.auth import decode_token
+from app.services.game import (
+    assigned_room, live_assignment, add_user_to_pool, remove_user_from_pool, estimate_wait,
+    connect_player, disconnect_player, start_game, start_turn, previous_question, submit_turn, cast_vote,
+    guess_location
+)
+from app.services.outbox import Outbox
+from app.services.ownership import RoomBusy
+from app.services.ratelimit import rate_limiter, rate_limited
+from app.services.pubsub import hub
+from app.services.room_cache import room_cache
+from app.services.store import store
+from typing import Dict, Optional
 import asyncio
+import time
 
 router = APIRouter(prefix="/game")
+log = get_logger("ws")
+message_log = get_logger("ws.messages")
+
+# Room socket messages by the key that marks them, in the order the handler checks them.
+MESSAGE_ACTIONS = ("submit_turn", "guess", "vote")
+
+TRY_AGAIN = {action: Frame.from_event({"type": "try_again", "action": action}) for action in MESSAGE_ACTIONS}
+SPY_ROLE = Frame.from_event({"type": "role", "role": "spy", "locations": get_settings().LOCATION_LIST})
 
 
 @router.post("/join-pool")
-async def join_pool(current_user: Dict = Depends(get_current_user)):
+async def join_pool(current_user: Dict = Depends(rate_limited("join_pool"))):
     username = current_user["username"]
-    assigned_room = await redis_client.get(f"assigned_room:{username}")
-    if assigned_room:
-        room_id = assigned_room.decode()
+    room_id = await live_assignment(username)
+    if room_id:
         return {"message": "Already assigned to a room", "room_id": room_id}
     success = await add_user_to_pool(username)
     if success:
@@ -25,188 +45,190 @@ async def join_pool(current_user: Dict = Depends(get_current_user)):
         return {"message": "Already in pool or assigned to a room"}
 
 
+@router.post("/leave-pool")
+async def leave_pool(current_user: Dict = Depends(rate_limited("leave_pool"))):
+    if await remove_user_from_pool(current_user["username"]):
+        return {"message": "Removed from waiting pool"}
+    return {"message": "Not in waiting pool"}
+
+
+@router.get("/estimated-wait")
+async def get_estimated_wait(current_user: Dict = Depends(rate_limited("estimated_wait"))):
+    return await estimate_wait(current_user["username"])
+
+
 @router.get("/pending-room")
-async def get_pending_room(current_user: Dict = Depends(get_current_user)):
+async def get_pending_room(
+    wait: float = Query(0, ge=0, le=get_settings().PENDING_ROOM_MAX_WAIT),
+    current_user: Dict = Depends(rate_limited("pending_room")),
+):
     username = current_user["username"]
-    room_id = await redis_client.get(f"assigned_room:{username}")
-    if not room_id:
-        raise HTTPException(status_code=404, detail="No room assigned yet")
-    return {"room_id": room_id.decode()}
+    if not wait:
+        room_id = await live_assignment(username)
+        if not room_id:
+            raise HTTPException(status_code=404, detail="No room assigned yet")
+        return {"room_id": room_id}
+    # Long poll: parked on the user's channel until the assignment is announced, instead of the client asking again.
+    async with hub.waiter(user_channel(username)) as assigned:
+        room_id = await live_assignment(username)
+        if room_id:
+            return {"room_id": room_id}
+        try:
+            frame = await asyncio.wait_for(assigned, wait)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=404, detail="No room assigned yet")
+    return {"room_id": frame.data["room_id"]}
 
 
 @router.websocket("/ws-user/{username}")
 async def user_websocket(websocket: WebSocket, username: str, token: str):
     try:
-        payload = jwt.decode(token, get_settings().JWT_SECRET_KEY, algorithms=[get_settings().JWT_ALGORITHM])
+        payload = decode_token(token)
         token_username = payload.get("sub")
+        bind_context(username=username)
         if not token_username or token_username != username:
             await websocket.close(code=4001)
             return
-        pubsub = redis_client.pubsub()
-        await pubsub.subscribe(f"user_channel:{username}")
-        await websocket.accept()
-
-        async def listener():
-            async for message in pubsub.listen():
-                if message['type'] == 'message':
-                    data_str = message['data'].decode('utf-8') if isinstance(message['data'], bytes) else message[
-                        'data']
-                    await websocket.send_text(data_str)
-
-        task = asyncio.create_task(listener())
+        wire = await codec.accept(websocket)
+        outbox = Outbox(websocket, wire, "user", username=username)
+        channel = user_channel(username)
+        await hub.subscribe(channel, outbox.put)
+        outbox.start()
+        WS_OPEN.labels("user").inc()
         try:
             while True:
-                await websocket.receive_json()
+                await codec.receive(websocket)
         except WebSocketDisconnect:
             pass
         finally:
-            task.cancel()
-            await pubsub.unsubscribe(f"user_channel:{username}")
+            WS_OPEN.labels("user").dec()
+            outbox.close()
+            await hub.unsubscribe(channel, outbox.put)
     except Exception as e:
-        print("WebSocket error:", str(e))
+        log.warning("User WebSocket error: %s", e)
         await websocket.close(code=4000)
 
 
 @router.websocket("/ws/{room_id}")
-async def room_websocket(websocket: WebSocket, room_id: str, token: str):
+async def room_websocket(websocket: WebSocket, room_id: str, token: str, last_event_id: Optional[str] = None):
     try:
-        payload = jwt.decode(token, get_settings().JWT_SECRET_KEY, algorithms=[get_settings().JWT_ALGORITHM])
+        payload = decode_token(token)
         username = payload.get("sub")
+        bind_context(room_id=room_id, username=username)
         if not username:
             await websocket.close(code=4001)
             return
-        assigned_room = await redis_client.get(f"assigned_room:{username}")
-        if not assigned_room or assigned_room.decode() != room_id:
+        if await assigned_room(username) != room_id:
             await websocket.close(code=4003)
             return
-        room_exists = await redis_client.exists(f"room:{room_id}")
-        if not room_exists:
-            await websocket.close(code=4004)
-            return
-        await websocket.accept()
-
-        room_data = await redis_client.hgetall(f"room:{room_id}")
-        users = room_data[b"users"].decode().split(",")
-        await redis_client.sadd(f"room:{room_id}:connected", username)
-        connected_users = await redis_client.scard(f"room:{room_id}:connected")
-        print(f"User {username} connected to room {room_id}. Connected users: {connected_users}/{len(users)}")
-
-        spy = room_data[b"spy"].decode()
-        secret_location = room_data[b"secret_location"].decode()
-        if username == spy:
-            await websocket.send_text(json.dumps({
-                "type": "role",
-                "role": "spy",
-                "locations": get_settings().LOCATION_LIST
-            }))
-        else:
-            await websocket.send_text(json.dumps({
-                "type": "role",
-                "role": "player",
-                "location": secret_location
-            }))
-
-        status = room_data[b"status"].decode()
-        if status == "active":
-            current_turn = int(room_data[b"current_turn"])
-            questions = json.loads(room_data[b"questions"])
-            previous_question = questions[-1]["question"] if questions else None
-            await websocket.send_text(json.dumps({
-                "type": "turn",
-                "current_player": users[current_turn],
-                "previous_question": previous_question,
-                "is_last": current_turn == len(users) - 1
-            }))
-
-        if connected_users == len(users):
-            game_started = await redis_client.hget(f"room:{room_id}", "game_started")
-            print(f"Game started flag for room {room_id}: {game_started}")
-            if not game_started or game_started.decode() != "true":
-                await redis_client.hset(f"room:{room_id}", "game_started", "true")
-                print(f"Starting game in room {room_id}")
-                await start_turn(room_id, 0)
-            else:
-                print(f"Game in room {room_id} already started")
-        else:
-            print(f"Waiting for more players to connect to room {room_id}")
-
-        pubsub = redis_client.pubsub()
-        await pubsub.subscribe(f"room_channel:{room_id}")
-        listener_task = asyncio.create_task(listen_to_room(websocket, pubsub))
+        await room_cache.track(room_id)
         try:
-            while True:
-                data = await websocket.receive_json()
-                room_data = await redis_client.hgetall(f"room:{room_id}")
-                status = room_data[b"status"].decode()
-                if status != "active" and status != "voting":
-                    continue
-                if "submit_turn" in data:
-                    current_turn = int(room_data[b"current_turn"])
-                    print(f"Received submit_turn from {username}, current_turn={current_turn}, users={users}")
-                    if username == users[current_turn]:
-                        answer = data.get("answer", "")
-                        question = data.get("question", "")
-                        questions = json.loads(room_data[b"questions"])
-                        questions.append({
-                            "player": username,
-                            "answer": answer,
-                            "question": question
-                        })
-                        await redis_client.hset(f"room:{room_id}", "questions", json.dumps(questions))
-                        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-                            "type": "new_submission",
-                            "player": username,
-                            "answer": answer,
-                            "question": question
-                        }))
-                        next_turn = current_turn + 1
-                        print(f"Updating current_turn to {next_turn} for room {room_id}, users length: {len(users)}")
-                        await redis_client.hset(f"room:{room_id}", "current_turn", str(next_turn))
-                        await start_turn(room_id, next_turn)
-                    else:
-                        print(f"Submission rejected: {username} does not match current player {users[current_turn]}")
-                elif "guess" in data and username == spy:
-                    guess = data["guess"].lower()
-                    if guess == secret_location.lower():
-                        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-                            "type": "spy_win",
-                            "spy": spy,
-                            "location": secret_location
+            state = await room_cache.get(room_id)
+            if state is None:
+                await websocket.close(code=4004)
+                return
+            wire = await codec.accept(websocket)
+
+            users = state.users
+            index = state.players.index(username)
+            connected_users = await connect_player(room_id, index)
+            log.debug("Connected (%d/%d)", connected_users, len(users))
+
+            spy = state.spy
+            secret_location = state.secret_location
+            if username == spy:
+                await wire.send(websocket, SPY_ROLE)
+            else:
+                await wire.send(websocket, Frame.from_event({
+                    "type": "role",
+                    "role": "player",
+                    "location": secret_location
+                }))
+
+            outbox = Outbox(websocket, wire, "room", username=username, room_id=room_id)
+            channel = room_channel(room_id)
+            # Subscribed before catching up, so nothing published in between is lost; the outbox
+            # drops the live events the catch-up already covered.
+            await hub.subscribe(channel, outbox.put)
+            WS_OPEN.labels("room").inc()
+            try:
+                missed = await store.events_since(room_id, last_event_id) if last_event_id else None
+                if missed is not None:
+                    log.debug("Resumed after %s with %d missed events", last_event_id, len(missed))
+                    for frame in missed:
+                        await wire.send(websocket, frame)
+                    if missed:
+                        last_event_id = missed[-1].data["event_id"]
+                else:
+                    last_event_id = None
+                    if state.status == "active" and state.current_player:
+                        await wire.send(websocket, Frame.from_event({
+                            "type": "turn",
+                            "current_player": state.current_player,
+                            "previous_question": await previous_question(room_id),
+                            "is_last": state.current_turn == len(users) - 1
                         }))
-                        await redis_client.hset(f"room:{room_id}", "status", "ended")
+                outbox.start(last_event_id)
+
+                if connected_users == len(users):
+                    if await start_game(room_id):
+                        log.info("Starting game")
+                        await start_turn(room_id, 0)
                     else:
-                        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-                            "type": "spy_lose",
-                            "spy": spy,
-                            "guess": guess,
-                            "location": secret_location
-                        }))
-                        await redis_client.hset(f"room:{room_id}", "status", "ended")
-                elif "vote" in data and status == "voting":
-                    voted_for = data["vote"]
-                    if voted_for:
-                        votes = json.loads(room_data[b"votes"])
-                        votes[username] = voted_for
-                        await redis_client.hset(f"room:{room_id}", "votes", json.dumps(votes))
-                        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-                            "type": "vote_cast",
-                            "player": username
-                        }))
-                        if len(votes) == len(users):
-                            await process_votes(room_id)
-        except WebSocketDisconnect:
-            await redis_client.srem(f"room:{room_id}:connected", username)
-            print(f"User {username} disconnected from room {room_id}")
+                        log.debug("Game already started")
+
+                while True:
+                    data = await codec.receive(websocket)
+                    # Dropped before touching the room state, so a flooding client costs next to nothing.
+                    limited = next((action for action in MESSAGE_ACTIONS if action in data), "message")
+                    if not rate_limiter.allow(limited, username):
+                        message_log.debug("Dropped %s over the rate limit", limited)
+                        continue
+                    started = time.perf_counter()
+                    action = "ignored"
+                    state = await room_cache.get(room_id)
+                    try:
+                        if state is None or (state.status != "active" and state.status != "voting"):
+                            pass
+                        elif "submit_turn" in data:
+                            action = "submit_turn"
+                            # Whose turn it is is left to the store: a cache lagging a turn event must not
+                            # turn away the player whose turn it really is.
+                            if state.status != "active":
+                                message_log.debug("Submission rejected: room is %s", state.status)
+                            elif not await submit_turn(
+                                room_id, username, data.get("question", ""), data.get("answer", "")
+                            ):
+                                room_cache.invalidate(room_id)
+                        elif "guess" in data and username == spy:
+                            action = "guess"
+                            await guess_location(room_id, spy, secret_location, data["guess"])
+                        elif "vote" in data and state.status == "voting" and username in state.users:
+                            action = "vote"
+                            voted_for = data["vote"]
+                            if voted_for and not await cast_vote(room_id, username, voted_for):
+                                room_cache.invalidate(room_id)
+                    except RoomBusy:
+                        # The room's owner is alive but slow to answer; the client sends the message again.
+                        log.warning("Room owner did not answer %s", action)
+                        outbox.put(TRY_AGAIN[action])
+                    elapsed = time.perf_counter() - started
+                    WS_MESSAGE_SECONDS.labels(action).observe(elapsed)
+                    message_log.debug("Handled %s in %.2f ms", action, elapsed * 1000)
+            except WebSocketDisconnect:
+                await disconnect_player(room_id, index)
+                log.debug("Disconnected")
+            finally:
+                WS_OPEN.labels("room").dec()
+                outbox.close()
+                await hub.unsubscribe(channel, outbox.put)
         finally:
-            listener_task.cancel()
-            await pubsub.unsubscribe(f"room_channel:{room_id}")
+            await room_cache.untrack(room_id)
+    except RoomBusy as e:
+        log.warning("Room WebSocket error: %s", e)
+        # 1013: try again later.
+        await websocket.close(code=1013)
     except Exception as e:
-        print(f"Room WebSocket error: {str(e)}")
+        log.warning("Room WebSocket error: %s", e)
         await websocket.close(code=4000)
 
-
-async def listen_to_room(websocket: WebSocket, pubsub):
-    async for message in pubsub.listen():
-        if message['type'] == 'message':
-            data_str = message['data'].decode('utf-8') if isinstance(message['data'], bytes) else message['data']
-            await websocket.send_text(data_str)
\ No newline at end of file
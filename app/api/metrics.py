@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, generate_latest
+from app.database import db_pool_stats
+from app.redis import redis_pool_stats
+from app.services.auth import hash_pool_stats
+
+router = APIRouter()
+
+# Pool gauges are read when scraped, so the hot paths pay nothing for them.
+POOL_CONNECTIONS = Gauge("pool_connections", "Connection and worker pool usage", ["pool", "state"])
+for pool, stats, states in (
+    ("database", db_pool_stats, ("checked_out", "idle", "overflow", "waiting")),
+    ("redis", redis_pool_stats, ("checked_out", "idle", "waiting")),
+    ("password_hashing", hash_pool_stats, ("pending",)),
+):
+    for state in states:
+        POOL_CONNECTIONS.labels(pool, state).set_function(lambda stats=stats, state=state: stats()[state])
+
+
+@router.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,76 @@
+from fastapi import APIRouter, Depends
+from app.core.log import logging_stats
+from app.database import db_pool_stats
+from app.core.config import get_settings
+from app.redis import redis_pool_stats
+from app.services.history import history
+from app.services.matchmaking import matchmaker
+from app.services.outbox import slow_clients
+from app.services.ownership import ownership
+from app.services.pubsub import hub
+from app.services.ratelimit import rate_limiter
+from app.services.room_cache import room_cache
+from app.services.store import store
+from app.services.auth import token_cache, user_cache, hash_pool_stats, require_ops_token
+
+router = APIRouter(prefix="/ops", dependencies=[Depends(require_ops_token)])
+
+
+@router.get("/stats")
+async def get_live_stats(ending_within: float = 60.0):
+    return await store.live_stats(ending_within)
+
+
+@router.get("/matchmaking")
+async def get_matchmaking_stats():
+    return matchmaker.stats()
+
+
+@router.get("/pubsub")
+async def get_pubsub_stats():
+    return hub.stats()
+
+
+@router.get("/slow-clients")
+async def get_slow_clients():
+    return slow_clients()
+
+
+@router.get("/history")
+async def get_history_stats():
+    return {
+        **history.stats(), "parked_batches": await history.parked(), "dead_batches": await history.dead_lettered(),
+    }
+
+
+@router.get("/ownership")
+async def get_ownership_stats():
+    return ownership.stats() if ownership else None
+
+
+@router.get("/rate-limits")
+async def get_rate_limit_stats():
+    return rate_limiter.stats()
+
+
+@router.get("/cache")
+async def get_cache_stats():
+    return {
+        "rooms": room_cache.stats(),
+        "tokens": token_cache.stats(),
+        "users": user_cache.stats(),
+    }
+
+
+@router.get("/logging")
+async def get_logging_stats():
+    return logging_stats()
+
+
+@router.get("/pools")
+async def get_pool_stats():
+    return {
+        "database": db_pool_stats(),
+        "redis": redis_pool_stats() if get_settings().STATE_BACKEND != "memory" else None,
+        "password_hashing": hash_pool_stats(),
+    }
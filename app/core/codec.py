@@ -0,0 +1,80 @@
+import msgpack
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect
+
+
+def dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+
+def loads(data):
+    return orjson.loads(data)
+
+
+def fragment(obj):
+    """Pre-encodes a constant part of a message so it is serialized once, not on every dumps."""
+    return orjson.Fragment(orjson.dumps(obj))
+
+
+class Frame:
+    """One event, encoded at most once per wire format no matter how many sockets it goes to."""
+
+    __slots__ = ("text", "_data", "_binary")
+
+    def __init__(self, text: str, data=None):
+        self.text = text
+        self._data = data
+        self._binary = None
+
+    @classmethod
+    def from_event(cls, event: dict):
+        return cls(dumps(event))
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = loads(self.text)
+        return self._data
+
+    @property
+    def binary(self):
+        if self._binary is None:
+            self._binary = msgpack.packb(self.data)
+        return self._binary
+
+
+class JsonCodec:
+    name = "json"
+
+    async def send(self, websocket: WebSocket, frame: Frame):
+        await websocket.send_text(frame.text)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    async def send(self, websocket: WebSocket, frame: Frame):
+        await websocket.send_bytes(frame.binary)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+
+
+async def accept(websocket: WebSocket):
+    """Accepts the socket with the first subprotocol the client offers that we speak; JSON otherwise."""
+    for subprotocol in websocket.scope.get("subprotocols", ()):
+        if subprotocol in CODECS:
+            await websocket.accept(subprotocol=subprotocol)
+            return CODECS[subprotocol]
+    await websocket.accept()
+    return CODECS["json"]
+
+
+async def receive(websocket: WebSocket):
+    # Either format is accepted from any client; the negotiated codec only decides what we send.
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    if message.get("bytes") is not None:
+        return msgpack.unpackb(message["bytes"])
+    return loads(message["text"])
@@ -0,0 +1,108 @@
+import zlib
+from app.core.config import get_settings
+
+settings = get_settings()
+
+# Redis Cluster hashes only the part of a key inside the first {...}, so every key that a script
+# or a single command touches together carries the same tag and lands in one slot:
+#   {<room_id>}       a room's hash, question list and event stream, and its pub/sub channel
+#   {pool:<shard>}    a matchmaking shard's pool, its room assignment buckets and its throughput buckets
+#   {timers}          the timer set and its arguments
+#   {stats}           the room indexes and game counters, read together by /ops/stats
+# Standalone Redis ignores the braces.
+
+
+def shard_of(username: str):
+    # Stable across processes (unlike hash()), so every worker sends a player to the same shard.
+    return zlib.crc32(username.encode()) % settings.MATCHMAKING_SHARDS
+
+
+def room_key(room_id: str):
+    return f"room:{{{room_id}}}"
+
+
+def connected_key(room_id: str):
+    return f"room:{{{room_id}}}:connected"
+
+
+def questions_key(room_id: str):
+    return f"room:{{{room_id}}}:questions"
+
+
+def events_key(room_id: str):
+    return f"room:{{{room_id}}}:events"
+
+
+def room_channel(room_id: str):
+    return f"room_channel:{{{room_id}}}"
+
+
+def user_channel(username: str):
+    return f"user_channel:{{{username}}}"
+
+
+def worker_channel(token: str):
+    return f"worker_channel:{{{token}}}"
+
+
+def worker_lease_key(token: str):
+    return f"worker_lease:{{{token}}}"
+
+
+def worker_rooms_key(token: str):
+    return f"worker_rooms:{{{token}}}"
+
+
+def ratelimit_key(username: str, action: str):
+    return f"ratelimit:{{{username}}}:{action}"
+
+
+def pool_tag(shard: int):
+    return f"{{pool:{shard}}}"
+
+
+def pool_key(shard: int):
+    return f"waiting_pool:{pool_tag(shard)}"
+
+
+def assigned_prefix(shard: int):
+    return f"assigned:{pool_tag(shard)}:"
+
+
+def assignment_bucket(username: str):
+    # Mirrored by bucket_of() in the claim script, which cannot use crc32.
+    hash = 0
+    for byte in username.encode():
+        hash = (hash * 31 + byte) % 4294967296
+    return hash % settings.ASSIGNMENT_BUCKETS
+
+
+def assigned_key(username: str):
+    """The hash holding the player's room assignment, in a field named after them."""
+    return assigned_prefix(shard_of(username)) + str(assignment_bucket(username))
+
+
+def matched_key(shard: int, bucket: int):
+    return f"matched:{pool_tag(shard)}:{bucket}"
+
+
+def lease_key(shard: int):
+    return f"matchmaker_lease:{pool_tag(shard)}"
+
+
+def wakeup_channel(shard: int):
+    return f"matchmaking:{pool_tag(shard)}"
+
+
+def rooms_key(status: str):
+    return f"rooms:{{stats}}:{status}"
+
+
+MATCHMAKERS_KEY = "matchmakers"
+ROOM_WORKERS_KEY = "room_workers"
+TIMERS_KEY = "{timers}"
+TIMER_ARGS_KEY = "{timers}:args"
+HISTORY_BUFFER_KEY = "history:buffer"
+HISTORY_DEAD_LETTER_KEY = "history:dead"
+ROOM_DEADLINES_KEY = "rooms:{stats}:deadlines"
+GAME_COUNTERS_KEY = "{stats}:counters"
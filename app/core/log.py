@@ -0,0 +1,137 @@
+import json
+import logging
+import queue
+import random
+import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from app.core.config import get_settings
+
+settings = get_settings()
+
+# Fields bound to the current task (a WebSocket connection, a timer) and added to every record it logs.
+_context: ContextVar[dict] = ContextVar("log_context", default={})
+
+# Attributes every LogRecord has; anything else on a record came in through `extra=`.
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+def get_logger(category: str):
+    return logging.getLogger(f"game.{category}")
+
+
+def bind_context(**fields):
+    """Adds fields to the rest of the current task's log records."""
+    _context.set({**_context.get(), **fields})
+
+
+@contextmanager
+def log_context(**fields):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingQueueHandler(QueueHandler):
+    """Hands records to the writer thread without blocking: adds the task's context, samples
+    chatty categories and drops records rather than wait when the queue is full."""
+
+    def __init__(self, log_queue, sample_rates):
+        super().__init__(log_queue)
+        self.sample_rates = sample_rates
+        self._rates = {}
+        self.dropped = 0
+
+    def _rate(self, name):
+        rate = self._rates.get(name)
+        if rate is None:
+            # The most specific configured category wins: "game.ws.messages" falls back to "game.ws".
+            rate, prefix = 1.0, name
+            while prefix:
+                if prefix in self.sample_rates:
+                    rate = self.sample_rates[prefix]
+                    break
+                prefix = prefix.rpartition(".")[0]
+            self._rates[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            rate = self._rate(record.name)
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        for key, value in _context.get().items():
+            record.__dict__.setdefault(key, value)
+        return super().filter(record)
+
+    def prepare(self, record):
+        # Only resolve the message here; JSON encoding happens on the writer thread.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(JsonFormatter())
+    _listener = QueueListener(log_queue, writer)
+
+    sample_rates = {f"game.{category}": rate for category, rate in settings.LOG_SAMPLE_RATES.items()}
+    root = logging.getLogger("game")
+    root.handlers = [SamplingQueueHandler(log_queue, sample_rates)]
+    root.propagate = False
+    root.setLevel(settings.LOG_LEVEL.upper())
+    for category, level in settings.LOG_LEVELS.items():
+        get_logger(category).setLevel(level.upper())
+    _listener.start()
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats():
+    handlers = logging.getLogger("game").handlers
+    return {
+        "queued": _listener.queue.qsize() if _listener else 0,
+        "dropped": sum(getattr(handler, "dropped", 0) for handler in handlers),
+    }
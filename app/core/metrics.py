@@ -0,0 +1,60 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# Metrics are per worker; aggregate across workers in the queries.
+
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+WAIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+MATCHMAKING_POOL_SIZE = Gauge(
+    "matchmaking_pool_size", "Players waiting in a pool shard at its last matchmaking pass", ["shard"]
+)
+MATCHMAKING_QUEUE_WAIT = Histogram(
+    "matchmaking_queue_wait_seconds", "Time from joining the pool to being placed in a room", buckets=WAIT_BUCKETS
+)
+ROOMS_CREATED = Counter("rooms_created_total", "Rooms created by this worker's matchmaker")
+GAMES_ENDED = Counter("games_ended_total", "Games finished, by outcome", ["outcome"])
+HISTORY_ROWS_PENDING = Gauge("history_rows_pending", "Game history rows waiting to be written to the database")
+HISTORY_ROWS_WRITTEN = Counter("history_rows_written_total", "Game history rows written to the database")
+HISTORY_BATCHES_BUFFERED = Counter(
+    "history_batches_buffered_total", "Game history batches parked in Redis because the database was unavailable"
+)
+HISTORY_BATCHES_DEAD = Counter(
+    "history_batches_dead_total", "Game history batches given up on because the database kept refusing them"
+)
+TRACKED_ROOMS = Gauge("tracked_rooms", "Rooms with sockets on this worker, by cached status", ["status"])
+
+WS_OPEN = Gauge("websockets_open", "Open WebSockets, by endpoint", ["endpoint"])
+WS_SEND_LAG_SECONDS = Histogram(
+    "websocket_send_lag_seconds", "Time a frame waits in a socket's send queue, by endpoint", ["endpoint"],
+    buckets=FAST_BUCKETS
+)
+WS_FRAMES_SHED = Counter(
+    "websocket_frames_shed_total", "Frames not sent to a slow socket, by endpoint and reason", ["endpoint", "reason"]
+)
+WS_SLOW_CLIENTS = Gauge(
+    "websocket_slow_clients", "Sockets with at least WS_SLOW_CLIENT_DEPTH frames waiting to be sent, by endpoint",
+    ["endpoint"]
+)
+WS_SLOW_DISCONNECTS = Counter(
+    "websocket_slow_disconnects_total", "Sockets closed because their send queue overflowed", ["endpoint"]
+)
+WS_MESSAGE_SECONDS = Histogram(
+    "room_message_seconds", "Time to handle one room WebSocket message, by action", ["action"], buckets=FAST_BUCKETS
+)
+
+RATE_LIMITED = Counter("rate_limited_total", "Requests and frames refused by the rate limiter, by action", ["action"])
+
+REDIS_COMMAND_SECONDS = Histogram(
+    "redis_command_seconds", "Redis round-trip latency, by command (pipelines as PIPELINE)", ["command"],
+    buckets=FAST_BUCKETS
+)
+REDIS_PIPELINE_COMMANDS = Counter("redis_pipeline_commands_total", "Commands sent inside pipelines")
+
+PUBSUB_LAG_SECONDS = Histogram(
+    "pubsub_delivery_lag_seconds", "Time from publishing an event to this worker dispatching it", buckets=FAST_BUCKETS
+)
+
+TIMER_LATENESS_SECONDS = Histogram(
+    "timer_lateness_seconds", "Time between a timer's due time and its handler starting, by kind", ["kind"],
+    buckets=FAST_BUCKETS
+)
@@ -1,5 +1,7 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.models.user import Base
+import app.models.game  # registers the game history tables for init_db
 from app.core.config import get_settings
 import ssl
 
@@ -15,11 +17,31 @@ connect_args = {}
 if ssl_context:
     connect_args["ssl"] = ssl_context
 
+
+class MonitoredQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that also counts checkouts in progress, i.e. callers waiting for a connection."""
+
+    waiting = 0
+
+    def _do_get(self):
+        self.waiting += 1
+        try:
+            return super()._do_get()
+        finally:
+            self.waiting -= 1
+
+
 engine = create_async_engine(
     settings.DATABASE_URL,
     connect_args=connect_args,
     echo=False,
-    future=True
+    future=True,
+    poolclass=MonitoredQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
 )
 
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
@@ -33,6 +55,17 @@ async def get_db():
             await session.rollback()
             raise
 
+def db_pool_stats():
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "waiting": pool.waiting,
+    }
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
\ No newline at end of file
@@ -4,20 +4,53 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.api.auth import router as auth_router
 from app.api.game import router as game_router
 from app.api.room import router as room_router
-from app.database import init_db
+from app.api.ops import router as ops_router
+from app.api.metrics import router as metrics_router
+from app.database import init_db, engine
 from app.core.config import get_settings
+from app.core.log import setup_logging, stop_logging
 import asyncio
 from contextlib import asynccontextmanager
 
 from app.services.game import find_match
+from app.services.history import history
+from app.services.matchmaking import matchmaker
+from app.services.ownership import ownership
+from app.services.pubsub import hub
+from app.services.timers import timers
 
 settings = get_settings()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    setup_logging()
     await init_db()
-    asyncio.create_task(matchmaking_loop())
+    if ownership:
+        # Before any room is created here.
+        await ownership.start()
+        ownership_task = asyncio.create_task(ownership.run())
+    matchmaking_task = asyncio.create_task(matchmaker.run(find_match))
+    timers_task = asyncio.create_task(timers.run())
+    history_task = asyncio.create_task(history.run())
     yield
+    matchmaker.stop()
+    timers.stop()
+    _, pending = await asyncio.wait([matchmaking_task, timers_task], timeout=5)
+    for task in pending:
+        task.cancel()
+    if ownership:
+        ownership.stop()
+        _, pending = await asyncio.wait([ownership_task], timeout=5)
+        for task in pending:
+            task.cancel()
+    # Stopped after the timers, whose handlers may still end games.
+    history.stop()
+    _, pending = await asyncio.wait([history_task], timeout=5)
+    for task in pending:
+        task.cancel()
+    await hub.stop()
+    await engine.dispose()
+    stop_logging()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -39,8 +72,5 @@ app.add_middleware(
 app.include_router(auth_router)
 app.include_router(game_router)
 app.include_router(room_router)
-
-async def matchmaking_loop():
-    while True:
-        await asyncio.sleep(5)
-        await find_match()
+app.include_router(ops_router)
+app.include_router(metrics_router)
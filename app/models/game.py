@@ -0,0 +1,31 @@
+from sqlalchemy import Column, DateTime, Integer, JSON, String
+from app.models.user import Base
+
+# Finished games, written behind the game by app/services/history.py. Rounds and votes are keyed by the
+# room id without foreign keys: they can be inserted before their game, possibly by another worker.
+
+class Game(Base):
+    __tablename__ = "games"
+    id = Column(String(36), primary_key=True)
+    spy = Column(String(50))
+    location = Column(String(100))
+    players = Column(JSON)
+    outcome = Column(String(32), index=True)
+    started_at = Column(DateTime(timezone=True))
+    ended_at = Column(DateTime(timezone=True), index=True)
+
+class Round(Base):
+    __tablename__ = "rounds"
+    game_id = Column(String(36), primary_key=True)
+    number = Column(Integer, primary_key=True, autoincrement=False)
+    questions = Column(JSON)
+    eliminated = Column(String(50), nullable=True)
+    ended_at = Column(DateTime(timezone=True))
+
+class Vote(Base):
+    __tablename__ = "votes"
+    game_id = Column(String(36), primary_key=True)
+    round = Column(Integer, primary_key=True, autoincrement=False)
+    ballot = Column(Integer, primary_key=True, autoincrement=False)
+    voter = Column(String(50), primary_key=True)
+    voted_for = Column(String(50))
@@ -1,5 +1,129 @@
+import asyncio
+import time
 import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+from redis.asyncio.cluster import ClusterPipeline
+from redis.exceptions import RedisClusterException
 from app.core.config import get_settings
+from app.core.metrics import REDIS_COMMAND_SECONDS, REDIS_PIPELINE_COMMANDS
 
 settings = get_settings()
-redis_client = redis.from_url(settings.REDIS_URL)
\ No newline at end of file
+# Script calls run at once by run_scripts in cluster mode; keeps a batch well under a node's connection cap.
+CLUSTER_SCRIPT_BATCH = 32
+
+
+class MonitoredConnectionPool(redis.BlockingConnectionPool):
+    """Blocking pool that also counts callers waiting for a connection."""
+
+    waiting = 0
+
+    async def get_connection(self, *args, **kwargs):
+        self.waiting += 1
+        try:
+            return await super().get_connection(*args, **kwargs)
+        finally:
+            self.waiting -= 1
+
+
+class TimedCommands:
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_SECONDS.labels(args[0]).observe(time.perf_counter() - started)
+
+
+class TimedPipeline:
+    async def execute(self, *args, **kwargs):
+        REDIS_PIPELINE_COMMANDS.inc(len(self))
+        started = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            REDIS_COMMAND_SECONDS.labels("PIPELINE").observe(time.perf_counter() - started)
+
+
+class InstrumentedPipeline(TimedPipeline, Pipeline):
+    pass
+
+
+class InstrumentedClusterPipeline(TimedPipeline, ClusterPipeline):
+    pass
+
+
+class InstrumentedRedis(TimedCommands, redis.Redis):
+    """Client that records the latency of every command and pipeline round trip."""
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedRedisCluster(TimedCommands, redis.RedisCluster):
+    """Cluster client with the same instrumentation. Cluster pipelines are never transactions:
+    they are split per node, so anything that must be atomic is a script on a single slot."""
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        if transaction or shard_hint:
+            raise RedisClusterException("Cluster pipelines support neither transactions nor shard hints")
+        return InstrumentedClusterPipeline(self)
+
+
+if settings.REDIS_CLUSTER:
+    # REDIS_URL names any node; the client discovers the rest and keeps up to
+    # REDIS_MAX_CONNECTIONS per node (over the limit it fails instead of waiting).
+    redis_pool = None
+    redis_client = InstrumentedRedisCluster.from_url(
+        settings.REDIS_URL,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+else:
+    redis_pool = MonitoredConnectionPool.from_url(
+        settings.REDIS_URL,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    redis_client = InstrumentedRedis(connection_pool=redis_pool)
+
+
+async def run_scripts(calls):
+    """Runs (script, keys, args) calls in one pipeline and returns their results in order. Cluster pipelines
+    refuse EVALSHA, so in cluster mode the calls go out directly instead, CLUSTER_SCRIPT_BATCH at a time."""
+    if settings.REDIS_CLUSTER:
+        results = []
+        for start in range(0, len(calls), CLUSTER_SCRIPT_BATCH):
+            results += await asyncio.gather(*(
+                script(keys=keys, args=args) for script, keys, args in calls[start:start + CLUSTER_SCRIPT_BATCH]
+            ))
+        return results
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for script, keys, args in calls:
+            await script(keys=keys, args=args, client=pipe)
+        return await pipe.execute()
+
+
+def redis_pool_stats():
+    if redis_pool is None:
+        nodes = redis_client.get_nodes()
+        idle = sum(len(node._free) for node in nodes)
+        return {
+            "nodes": len(nodes),
+            "max_connections": settings.REDIS_MAX_CONNECTIONS * len(nodes),
+            "checked_out": sum(len(node._connections) for node in nodes) - idle,
+            "idle": idle,
+            "waiting": 0,
+        }
+    return {
+        "max_connections": redis_pool.max_connections,
+        "checked_out": len(redis_pool._in_use_connections),
+        "idle": len(redis_pool._available_connections),
+        "waiting": redis_pool.waiting,
+    }
@@ -1,22 +1,59 @@
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from jose import jwt, JWTError
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 from datetime import datetime, timezone, timedelta
 from app.core.config import get_settings
 from app.models.user import User
 from app.database import async_session
+from app.core.cache import TTLCache
 from sqlalchemy.future import select
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import secrets
 
 settings = get_settings()
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+hash_executor = ThreadPoolExecutor(max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+hash_pending = 0
+hash_rejected = 0
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
+token_cache = TTLCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL)
+user_cache = TTLCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def run_password_hash(func, *args):
+    # bcrypt holds the CPU for hundreds of milliseconds, so it runs in a bounded pool off the event loop
+    # and callers are turned away with 429 once the queue is full instead of piling up behind it.
+    global hash_pending, hash_rejected
+    if hash_pending >= settings.PASSWORD_HASH_MAX_PENDING:
+        hash_rejected += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many authentication requests, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    hash_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_executor, func, *args)
+    finally:
+        hash_pending -= 1
+
+async def verify_and_update_password(plain_password, hashed_password):
+    """Returns (valid, new_hash); new_hash is set when the stored hash uses an outdated cost."""
+    return await run_password_hash(pwd_context.verify_and_update, plain_password, hashed_password)
+
+async def hash_password(password):
+    return await run_password_hash(pwd_context.hash, password)
 
-def hash_password(password):
-    return pwd_context.hash(password)
+def hash_pool_stats():
+    return {
+        "workers": settings.PASSWORD_HASH_WORKERS,
+        "pending": hash_pending,
+        "max_pending": settings.PASSWORD_HASH_MAX_PENDING,
+        "rejected": hash_rejected,
+        "bcrypt_rounds": settings.BCRYPT_ROUNDS,
+    }
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -24,6 +61,26 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
 
+def decode_token(token: str):
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        token_cache.set(key, payload, expires_at=payload.get("exp"))
+    return payload
+
+async def user_exists(username: str):
+    exists = user_cache.get(username)
+    if exists is None:
+        async with async_session() as session:
+            result = await session.execute(select(User.id).where(User.username == username))
+            exists = result.first() is not None
+        user_cache.set(username, exists, ttl=None if exists else settings.USER_CACHE_NEGATIVE_TTL)
+    return exists
+
+def invalidate_user(username: str):
+    user_cache.pop(username)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -31,16 +88,18 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        payload = decode_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
 
-    async with async_session() as session:
-        result = await session.execute(select(User).where(User.username == username))
-        user = result.scalars().first()
-        if user is None:
-            raise credentials_exception
-        return {"username": user.username}
\ No newline at end of file
+    if not await user_exists(username):
+        raise credentials_exception
+    return {"username": username}
+
+
+async def require_ops_token(x_ops_token: str = Header(default="")):
+    if not settings.OPS_TOKEN or not secrets.compare_digest(x_ops_token, settings.OPS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized")
@@ -0,0 +1,65 @@
+from app.redis import redis_client
+from app.core.codec import Frame
+from app.core.config import get_settings
+from app.core.keys import room_key, events_key, room_channel
+from app.services.pubsub import encode_event
+
+settings = get_settings()
+
+# How long a stream outlives its room: room_closed is appended after the room's keys are deleted.
+ENDED_ROOM_EVENTS_TTL_MS = 60_000
+
+# Appends an event to the room's capped stream and publishes it with its stream id as event_id,
+# so live delivery and reconnect catch-up carry the same ids. The stream follows the room's TTL.
+# KEYS: room:{<id>}:events, room_channel:{<id>}, room:{<id>}
+# ARGV: maxlen, encoded event, PUBLISH or SPUBLISH, ttl_ms once the room is gone
+APPEND_EVENT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'event', ARGV[2])
+local ttl = redis.call('PTTL', KEYS[3])
+redis.call('PEXPIRE', KEYS[1], ttl > 0 and ttl or ARGV[4])
+-- Same framing as with_id() below.
+redis.call(ARGV[3], KEYS[2], '{"event_id":"' .. id .. '",' .. string.sub(ARGV[2], 2))
+return id
+"""
+
+append_event_script = redis_client.register_script(APPEND_EVENT)
+
+
+def with_id(event_id: str, event: str) -> str:
+    # event_id goes first: the hub reads sent_at from the end of the message.
+    return f'{{"event_id":"{event_id}",{event[1:]}'
+
+
+def parse_event_id(event_id: str):
+    """Stream ids compare as (milliseconds, sequence); None if it is not one."""
+    try:
+        ms, _, seq = event_id.partition("-")
+        return int(ms), int(seq or 0)
+    except (AttributeError, ValueError):
+        return None
+
+
+async def publish_room_event(room_id: str, event: dict):
+    event_id = await append_event_script(
+        keys=[events_key(room_id), room_channel(room_id), room_key(room_id)],
+        args=[
+            settings.ROOM_EVENTS_MAXLEN, encode_event(event),
+            "SPUBLISH" if settings.REDIS_CLUSTER else "PUBLISH", ENDED_ROOM_EVENTS_TTL_MS,
+        ]
+    )
+    return event_id.decode()
+
+
+async def room_events_since(room_id: str, last_event_id: str):
+    """Frames for every event after last_event_id, or None if that event is no longer in the stream
+    (trimmed, expired or never there) and the client has to start from a snapshot instead."""
+    after = parse_event_id(last_event_id)
+    if after is None:
+        return None
+    # Inclusive, so finding the client's own last event proves nothing between it and the rest was trimmed.
+    entries = await redis_client.xrange(
+        events_key(room_id), min=f"{after[0]}-{after[1]}", count=settings.ROOM_EVENTS_MAXLEN * 2
+    )
+    if not entries or parse_event_id(entries[0][0].decode()) != after:
+        return None
+    return [Frame(with_id(event_id.decode(), fields[b"event"].decode())) for event_id, fields in entries[1:]]
@@ -1,217 +1,346 @@
 import random
-import asyncio
-import json
 from uuid import uuid4
-from app.redis import redis_client
+from app.core.codec import fragment
 from app.core.config import get_settings
+from app.core.log import get_logger
+from app.core.metrics import MATCHMAKING_POOL_SIZE, GAMES_ENDED
+from app.core.keys import user_channel
+from app.services.matchmaking import matchmaker, room_sizes
+from app.services.pubsub import encode_event, hub
+from app.services.history import history
+from app.services.ownership import room_action
+from app.services.store import store
+from app.services.timers import timers
 import time
 
 settings = get_settings()
+pool_log = get_logger("pool")
+room_log = get_logger("rooms")
+turn_log = get_logger("turns")
+vote_log = get_logger("votes")
+
+# The location list is the same in every spy message, so it is encoded once.
+LOCATIONS = fragment(settings.LOCATION_LIST)
+
+
+async def assigned_room(username: str):
+    return await store.assigned_room(username)
+
+
+async def live_assignment(username: str):
+    """The player's room, if it still exists. An assignment whose room expired without a cleanup
+    is dropped here, as the assignment hashes only expire once no room was assigned in them for a game."""
+    room_id = await assigned_room(username)
+    if room_id and not await store.room_exists(room_id):
+        await store.clear_assignment(username)
+        return None
+    return room_id
 
 
 async def add_user_to_pool(username: str):
-    assigned_room = await redis_client.get(f"assigned_room:{username}")
-    if assigned_room:
-        print(f"User {username} already has room: {assigned_room.decode()}")
+    room_id = await live_assignment(username)
+    if room_id:
+        pool_log.debug("User %s already has room %s", username, room_id, extra={"username": username})
         return False
-    await redis_client.sadd("waiting_users", username)
-    print(f"Added {username} to waiting pool")
+    # Keeps the original join time, so joining again does not send anyone to the back of the line.
+    await store.join_pool(username)
+    pool_log.debug("Added %s to waiting pool", username, extra={"username": username})
     return True
 
 
-async def find_match():
-    count = await redis_client.scard("waiting_users")
-    if count >= 3:
-        users = await redis_client.srandmember("waiting_users", number=8)
-        users = [u.decode('utf-8') for u in users]
-        if len(users) >= 3:
-            room_id = str(uuid4())
-            secret_location = random.choice(settings.LOCATION_LIST)
-            spy = random.choice(users)
-            room_key = f"room:{room_id}"
-            await redis_client.hset(room_key, mapping={
-                "secret_location": secret_location,
-                "spy": spy,
-                "users": ",".join(users),
-                "status": "active",
-                "current_turn": "0",
-                "questions": json.dumps([]),
-                "votes": json.dumps({}),
-                "start_time": str(time.time()),
-                "game_started": "false"
-            })
-            await redis_client.expire(room_key, 960)  # 16 minutes
-            for user in users:
-                await redis_client.srem("waiting_users", user)
-                await redis_client.setex(f"assigned_room:{user}", 960, room_id)
-                if user == spy:
-                    await redis_client.publish(f"user_channel:{user}", json.dumps({
-                        "type": "assigned_room",
-                        "room_id": room_id,
-                        "role": "spy",
-                        "locations": settings.LOCATION_LIST
-                    }))
-                else:
-                    await redis_client.publish(f"user_channel:{user}", json.dumps({
-                        "type": "assigned_room",
-                        "room_id": room_id,
-                        "role": "player",
-                        "location": secret_location
-                    }))
-            print(f"Room {room_id} created with users: {users}")
-            asyncio.create_task(game_timeout(room_id))
+async def remove_user_from_pool(username: str):
+    removed = await store.leave_pool(username)
+    if removed:
+        pool_log.debug("Removed %s from waiting pool", username, extra={"username": username})
+    return removed
+
+
+async def estimate_wait(username: str):
+    now = time.time()
+    rank, joined_at, queued, placed = await store.queue_position(username)
+    # Players placed per second over the last MATCHMAKING_RATE_WINDOW seconds, in this player's shard.
+    rate = placed / settings.MATCHMAKING_RATE_WINDOW
+    position = rank + 1 if rank is not None else queued + 1
+    return {
+        "in_pool": rank is not None,
+        "position": position,
+        "queued": queued,
+        "waited_seconds": round(now - joined_at, 1) if joined_at is not None else None,
+        "throughput_per_second": round(rate, 3),
+        "estimated_wait_seconds": round(position / rate, 1) if rate else None,
+    }
+
+
+async def find_match(shard: int):
+    count = await store.pool_size(shard)
+    MATCHMAKING_POOL_SIZE.labels(shard).set(count)
+    rooms = 0
+    for size in room_sizes(count):
+        if not await create_room(shard, size):
+            break
+        rooms += 1
+    return rooms
+
+
+async def create_room(shard: int, size: int):
+    room_id = str(uuid4())
+    secret_location = random.choice(settings.LOCATION_LIST)
+    now = time.time()
+    claimed = await store.claim_players(shard, room_id, size)
+    if not claimed:
+        return None
+    users, joined_at = claimed
+    spy = random.randrange(len(users))
+    matchmaker.record_waits([now - ts for ts in joined_at])
+    await store.create_room(room_id, shard, users, spy, secret_location, now)
+
+    spy_message = encode_event({
+        "type": "assigned_room",
+        "room_id": room_id,
+        "role": "spy",
+        "locations": LOCATIONS
+    })
+    player_message = encode_event({
+        "type": "assigned_room",
+        "room_id": room_id,
+        "role": "player",
+        "location": secret_location
+    })
+    # Announced only after the room is written: a cluster pipeline sends to each node concurrently,
+    # so in the same pipeline a player could hear about the room before it exists.
+    await hub.publish(*(
+        (user_channel(user), spy_message if index == spy else player_message) for index, user in enumerate(users)
+    ))
+    room_log.info("Room created", extra={"room_id": room_id, "users": users})
+    await timers.schedule("game", room_id, settings.GAME_TIMEOUT)
+    return room_id
+
+
+@room_action
+async def connect_player(room_id: str, index: int):
+    """Marks the room socket of the player at this roster index as connected; returns how many are."""
+    return await store.connect(room_id, index)
+
 
+@room_action
+async def disconnect_player(room_id: str, index: int):
+    await store.disconnect(room_id, index)
 
+
+@room_action
+async def start_game(room_id: str):
+    return await store.start_game(room_id)
+
+
+@room_action
+async def previous_question(room_id: str):
+    return await store.previous_question(room_id)
+
+
+@room_action
 async def start_turn(room_id: str, turn_index: int):
-    room_key = f"room:{room_id}"
-    room_data = await redis_client.hgetall(room_key)
-    if not room_data or room_data[b"status"].decode() != "active":
-        print(f"Cannot start turn in room {room_id}: Room does not exist or game is not active")
-        return
-    users = room_data[b"users"].decode().split(",")
-    print(f"Starting turn in room {room_id}, turn_index={turn_index}, users={users}")
-    if turn_index >= len(users):
-        print(f"Starting voting in room {room_id}, turn_index={turn_index}, users length={len(users)}")
-        await redis_client.hset(room_key, "status", "voting")
-        await redis_client.publish(f"room_channel:{room_id}", json.dumps({"type": "start_voting"}))
-        asyncio.create_task(voting_timeout(room_id))
+    state = await store.turn_state(room_id)
+    if not state or state[0] != "active":
+        turn_log.info("Cannot start turn: room does not exist or game is not active", extra={"room_id": room_id})
         return
+    _, users, previous_question = state
+    await announce_turn(room_id, turn_index, users, previous_question)
+
+
+async def announce_turn(room_id: str, turn_index: int, users, previous_question):
     current_player = users[turn_index]
-    questions = json.loads(room_data[b"questions"])
-    previous_question = questions[-1]["question"] if questions else None
-    print(
-        f"Sending turn message for room {room_id}: current_player={current_player}, turn_index={turn_index}, is_last={turn_index == len(users) - 1}")
-    await redis_client.publish(f"room_channel:{room_id}", json.dumps({
+    turn_log.debug(
+        "Turn %d of %d: %s", turn_index + 1, len(users), current_player,
+        extra={"room_id": room_id, "turn_index": turn_index, "current_player": current_player}
+    )
+    await store.append_event(room_id, {
         "type": "turn",
         "current_player": current_player,
         "previous_question": previous_question,
         "is_last": turn_index == len(users) - 1
-    }))
-    asyncio.create_task(turn_timeout(room_id, turn_index))
+    })
+    await timers.schedule("turn", room_id, settings.TURN_TIMEOUT, turn_index=turn_index)
+
+
+async def advance_turn(room_id: str, result):
+    if result[0] == "voting":
+        vote_log.debug("Starting voting", extra={"room_id": room_id})
+        await store.move_room(room_id, "active", "voting")
+        await store.append_event(room_id, {"type": "start_voting"})
+        await timers.cancel(room_id, "turn")
+        await timers.schedule("voting", room_id, settings.VOTING_TIMEOUT)
+        return
+    _, next_turn, users, previous_question = result
+    await announce_turn(room_id, next_turn, users, previous_question)
+
+
+@room_action
+async def submit_turn(room_id: str, username: str, question: str, answer: str):
+    result = await store.advance_turn(room_id, None, username, question, answer)
+    if not result:
+        turn_log.debug("Submission rejected: not %s's turn", username, extra={"room_id": room_id, "username": username})
+        return False
+    await store.append_event(room_id, {
+        "type": "new_submission",
+        "player": username,
+        "answer": answer,
+        "question": question
+    })
+    await advance_turn(room_id, result)
+    return True
 
 
 async def turn_timeout(room_id: str, turn_index: int):
-    await asyncio.sleep(150)  # 2.5 minutes
-    room_key = f"room:{room_id}"
-    room_data = await redis_client.hgetall(room_key)
-    if room_data and room_data[b"status"].decode() == "active" and int(room_data[b"current_turn"]) == turn_index:
-        print(f"Turn timeout in room {room_id} for turn {turn_index}")
-        next_turn = turn_index + 1
-        await redis_client.hset(room_key, "current_turn", str(next_turn))
-        await start_turn(room_id, next_turn)
+    result = await store.advance_turn(room_id, turn_index, "", "", "")
+    if result:
+        turn_log.info("Turn %d timed out", turn_index, extra={"room_id": room_id, "turn_index": turn_index})
+        await advance_turn(room_id, result)
+
+
+@room_action
+async def cast_vote(room_id: str, username: str, voted_for: str):
+    result = await store.cast_vote(room_id, username, voted_for)
+    if not result:
+        return False
+    await store.append_event(room_id, {
+        "type": "vote_cast",
+        "player": username
+    })
+    if len(result) > 1:
+        await apply_vote_outcome(room_id, result[1:])
+    return True
 
 
 async def process_votes(room_id: str):
-    room_key = f"room:{room_id}"
-    room_data = await redis_client.hgetall(room_key)
-    votes = json.loads(room_data[b"votes"])
-    users = room_data[b"users"].decode().split(",")
-
-    vote_counts = {}
-    for user in users:
-        vote_counts[user] = 0
-    for voter, voted_for in votes.items():
-        if voted_for in vote_counts:
-            vote_counts[voted_for] += 1
-
-    max_votes = max(vote_counts.values())
-    top_voted_players = [player for player, count in vote_counts.items() if count == max_votes]
-
-    if len(top_voted_players) > 1:
-        print(f"Tie in votes in room {room_id}: {top_voted_players} with {max_votes} votes each")
-        # Reset votes and start a new voting round
-        await redis_client.hset(room_key, "votes", json.dumps({}))
-        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
+    result = await store.process_votes(room_id)
+    if result:
+        await apply_vote_outcome(room_id, result)
+
+
+async def apply_vote_outcome(room_id: str, outcome):
+    kind = outcome[0]
+    # Queued in memory only; the history writer inserts it later, off this path.
+    voted_out = outcome[2] if kind == "eliminated" else outcome[1] if kind == "players_win" else None
+    history.record_round(room_id, outcome[-1], voted_out)
+    if kind == "tie":
+        vote_log.debug("Tie in votes", extra={"room_id": room_id})
+        await store.append_event(room_id, {
             "type": "voting_tie"
-        }))
-        await redis_client.hset(room_key, "status", "voting")
-        asyncio.create_task(voting_timeout(room_id))
+        })
+        await timers.schedule("voting", room_id, settings.VOTING_TIMEOUT)
         return
 
-    voted_player = top_voted_players[0]
-    spy = room_data[b"spy"].decode()
-
-    if voted_player == spy:
-        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
+    spy = outcome[1]
+    if kind == "players_win":
+        GAMES_ENDED.labels("players_win").inc()
+        await store.append_event(room_id, {
             "type": "players_win",
             "spy": spy
-        }))
-        await redis_client.hset(room_key, "status", "ended")
-        await cleanup_room(room_id)  # Clean up room and player assignments
+        })
+        await cleanup_room(room_id, "players_win")  # Clean up room and player assignments
+        return
+
+    _, _, voted_player, remaining, _ = outcome
+    await store.player_left(room_id, reopened=remaining > 2)
+    await store.append_event(room_id, {
+        "type": "player_eliminated",
+        "player": voted_player
+    })
+    if remaining == 2:
+        GAMES_ENDED.labels("spy_win_two_players").inc()
+        await store.append_event(room_id, {
+            "type": "spy_win_two_players",
+            "spy": spy
+        })
+        await cleanup_room(room_id, "spy_win_two_players")  # Clean up room and player assignments
+    elif remaining > 2:
+        vote_log.debug("Starting new round with %d players", remaining, extra={"room_id": room_id})
+        await timers.cancel(room_id, "voting")
+        await start_turn(room_id, 0)
     else:
-        users.remove(voted_player)
-
-        await redis_client.hset(room_key, mapping={
-            "users": ",".join(users),
-            "current_turn": "0",
-            "questions": json.dumps([]),
-            "votes": json.dumps({}),
-            "status": "active"
+        GAMES_ENDED.labels("spy_win").inc()
+        await store.append_event(room_id, {
+            "type": "spy_win",
+            "spy": spy
         })
-        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-            "type": "player_eliminated",
-            "player": voted_player
-        }))
-        if len(users) == 2:
-            await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-                "type": "spy_win_two_players",
-                "spy": spy
-            }))
-            await redis_client.hset(room_key, "status", "ended")
-            await cleanup_room(room_id)  # Clean up room and player assignments
-        elif len(users) > 2:
-            print(f"Starting new round in room {room_id} with remaining players: {users}")
-            await start_turn(room_id, 0)
-        else:
-            await redis_client.publish(f"room_channel:{room_id}", json.dumps({
-                "type": "spy_win",
-                "spy": spy
-            }))
-            await redis_client.hset(room_key, "status", "ended")
-            await cleanup_room(room_id)  # Clean up room and player assignments
+        await cleanup_room(room_id, "spy_win")  # Clean up room and player assignments
+
+
+@room_action
+async def leave_game(room_id: str, username: str):
+    remaining = await store.leave_room(room_id, username)
+    if remaining is None:
+        return
+    if remaining > 0:
+        # Once the last one leaves, the cleanup takes the player count down.
+        await store.player_left(room_id)
+        await store.append_event(room_id, {
+            "type": "player_left",
+            "player": username
+        })
+    else:
+        await cleanup_room(room_id, "abandoned")
 
 
 async def voting_timeout(room_id: str):
-    await asyncio.sleep(60)  # 1 minute
-    room_key = f"room:{room_id}"
-    room_data = await redis_client.hgetall(room_key)
-    if room_data[b"status"].decode() == "voting":
-        print(f"Voting timeout in room {room_id}")
-        await process_votes(room_id)
+    vote_log.info("Voting timed out", extra={"room_id": room_id})
+    await process_votes(room_id)
 
 
 async def game_timeout(room_id: str):
-    await asyncio.sleep(960)  # 16 minutes
-    room_key = f"room:{room_id}"
-    room_data = await redis_client.hgetall(room_key)
-    if room_data and room_data[b"status"].decode() == "active":
-        spy = room_data[b"spy"].decode()
-        await redis_client.publish(f"room_channel:{room_id}", json.dumps({
+    spy = await store.end_game(room_id, "active", "voting")
+    if spy:
+        GAMES_ENDED.labels("spy_win_timeout").inc()
+        await store.append_event(room_id, {
             "type": "spy_win_timeout",
             "spy": spy
-        }))
-        await redis_client.hset(room_key, "status", "ended")
-        await cleanup_room(room_id)  # Clean up room and player assignments
+        })
+        await cleanup_room(room_id, "spy_win_timeout")  # Clean up room and player assignments
 
 
-async def cleanup_room(room_id: str):
-    room_key = f"room:{room_id}"
-    room_data = await redis_client.hgetall(room_key)
-    if not room_data:
-        print(f"Room {room_id} not found during cleanup")
+@room_action
+async def guess_location(room_id: str, spy: str, secret_location: str, guess: str):
+    if not await store.end_game(room_id, "active", "voting"):
         return
+    guess = guess.lower()
+    if guess == secret_location.lower():
+        GAMES_ENDED.labels("spy_guess").inc()
+        await store.append_event(room_id, {
+            "type": "spy_win",
+            "spy": spy,
+            "location": secret_location
+        })
+        await cleanup_room(room_id, "spy_guess")
+    else:
+        GAMES_ENDED.labels("spy_lose").inc()
+        await store.append_event(room_id, {
+            "type": "spy_lose",
+            "spy": spy,
+            "guess": guess,
+            "location": secret_location
+        })
+        await cleanup_room(room_id, "spy_lose")
 
-    users = room_data[b"users"].decode().split(",")
-
-    await redis_client.delete(room_key)
-    await redis_client.delete(f"room:{room_id}:connected")
 
-    for user in users:
-        await redis_client.delete(f"assigned_room:{user}")
+@room_action
+async def cleanup_room(room_id: str, outcome: str = None):
+    game = await store.close_room(room_id)
+    if not game:
+        room_log.info("Room not found during cleanup", extra={"room_id": room_id})
+        return
+    if outcome:
+        history.record_game(room_id, outcome, game)
+    users = game["alive"]
+    await timers.cancel(room_id)
 
-    await redis_client.publish(f"room_channel:{room_id}", json.dumps({
+    await store.append_event(room_id, {
         "type": "room_closed",
         "message": "The game has ended and the room has been closed."
-    }))
+    })
+
+    room_log.info("Room cleaned up", extra={"room_id": room_id, "users": users})
+
 
-    print(f"Cleaned up room {room_id} and freed users: {users}")
\ No newline at end of file
+timers.register("turn", turn_timeout)
+timers.register("voting", voting_timeout)
+timers.register("game", game_timeout)
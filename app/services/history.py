@@ -0,0 +1,222 @@
+import asyncio
+import time
+from collections import deque
+from datetime import datetime, timezone
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from app.redis import redis_client
+from app.database import async_session, engine
+from app.models.game import Game, Round, Vote
+from app.core.codec import dumps, loads
+from app.core.config import get_settings
+from app.core.keys import HISTORY_BUFFER_KEY, HISTORY_DEAD_LETTER_KEY
+from app.core.log import get_logger
+from app.core.metrics import (
+    HISTORY_ROWS_PENDING, HISTORY_ROWS_WRITTEN, HISTORY_BATCHES_BUFFERED, HISTORY_BATCHES_DEAD
+)
+
+settings = get_settings()
+log = get_logger("history")
+
+TABLES = {"games": Game, "rounds": Round, "votes": Vote}
+TIMESTAMPS = ("started_at", "ended_at")
+insert = sqlite_insert if engine.dialect.name == "sqlite" else pg_insert
+
+
+def unreachable(error: Exception):
+    """The database could not be reached at all, so the batch is not to blame."""
+    return isinstance(error, (OSError, InterfaceError, PoolTimeoutError)) or getattr(
+        error, "connection_invalidated", False
+    )
+
+
+def transient(error: Exception):
+    # Deadlocks, timeouts, a server shutting down. Anything else (a constraint, a value too long for its
+    # column) fails the same way however often the batch is retried.
+    return unreachable(error) or isinstance(error, OperationalError)
+
+
+class HistoryWriter:
+    """Write-behind persistence of finished games. The game path only appends rows in memory; a background
+    task inserts them in batches. Batches that fail with a transient error are parked in a Redis list, which
+    outlives the outage (and this worker) and is drained by whichever worker next finds the database up;
+    without a client (STATE_BACKEND=memory) they wait in memory instead. Batches that fail for good, or
+    HISTORY_MAX_ATTEMPTS times while the database was up, go to a dead-letter list instead of holding up the rest.
+    Inserts ignore rows already written, so a batch can safely be written twice."""
+
+    def __init__(self, client):
+        self._client = client
+        self._rows = deque()
+        self._full = asyncio.Event()
+        self._stopping = False
+        self.written = 0
+        self.buffered = 0
+        self.dropped = 0
+        self.dead = 0
+
+    def record_round(self, room_id: str, record, eliminated: str = None):
+        """Takes a ballot record as the store returns it with a vote outcome."""
+        round, ballot, votes, questions = record
+        for voter, voted_for in votes:
+            self._put("votes", {
+                "game_id": room_id, "round": round, "ballot": ballot, "voter": voter, "voted_for": voted_for,
+            })
+        if questions is not None:
+            self._put("rounds", {
+                "game_id": room_id, "number": round, "questions": questions,
+                "eliminated": eliminated, "ended_at": time.time(),
+            })
+
+    def record_game(self, room_id: str, outcome: str, game: dict):
+        """Takes the game as the store's close_room returns it."""
+        now = time.time()
+        self._put("games", {
+            "id": room_id, "spy": game["spy"], "location": game["secret_location"],
+            "players": game["players"], "outcome": outcome, "started_at": game["started_at"], "ended_at": now,
+        })
+        if game["questions"]:
+            # The round the game ended in, cut short by the timeout, the spy's guess or everyone leaving.
+            self._put("rounds", {
+                "game_id": room_id, "number": game["round"],
+                "questions": game["questions"], "eliminated": None, "ended_at": now,
+            })
+
+    def _put(self, table: str, row: dict):
+        if len(self._rows) >= settings.HISTORY_MAX_PENDING:
+            self._rows.popleft()
+            self.dropped += 1
+        self._rows.append((table, row))
+        if len(self._rows) >= settings.HISTORY_BATCH_SIZE:
+            self._full.set()
+
+    def pending(self):
+        return len(self._rows)
+
+    async def parked(self):
+        return await self._client.llen(HISTORY_BUFFER_KEY) if self._client is not None else 0
+
+    async def dead_lettered(self):
+        return await self._client.llen(HISTORY_DEAD_LETTER_KEY) if self._client is not None else 0
+
+    def stats(self):
+        return {
+            "pending": len(self._rows), "written": self.written, "buffered": self.buffered, "dropped": self.dropped,
+            "dead_lettered": self.dead,
+        }
+
+    async def _insert(self, rows):
+        tables = {}
+        for table, row in rows:
+            row = dict(row)
+            for column in TIMESTAMPS:
+                if column in row:
+                    row[column] = datetime.fromtimestamp(row[column], timezone.utc)
+            tables.setdefault(table, []).append(row)
+        async with async_session() as session:
+            for table, values in tables.items():
+                await session.execute(insert(TABLES[table]).on_conflict_do_nothing(), values)
+            await session.commit()
+        self.written += len(rows)
+        HISTORY_ROWS_WRITTEN.inc(len(rows))
+
+    async def _flush(self, rows):
+        """Writes, parks or dead-letters a batch; False if none of it worked and the rows went back to the queue."""
+        try:
+            await self._insert(rows)
+            return True
+        except Exception as e:
+            if not transient(e):
+                await self._dead_letter(rows, 1, e)
+                return True
+            if self._client is None:
+                log.warning("Could not write %d history rows, keeping them in memory: %s", len(rows), e)
+                self._rows.extendleft(reversed(rows))
+                return False
+            log.warning("Could not write %d history rows, buffering them in Redis: %s", len(rows), e)
+            attempts = 0 if unreachable(e) else 1
+        try:
+            await self._client.rpush(HISTORY_BUFFER_KEY, dumps({"attempts": attempts, "rows": rows}))
+            self.buffered += 1
+            HISTORY_BATCHES_BUFFERED.inc()
+            return True
+        except Exception:
+            log.exception("Could not buffer history rows, keeping them in memory")
+            self._rows.extendleft(reversed(rows))
+            return False
+
+    async def _drain_buffer(self):
+        if self._client is None:
+            return
+        # One parked batch per idle tick; LPOP hands it to exactly one worker.
+        batch = await self._client.lpop(HISTORY_BUFFER_KEY)
+        if batch is None:
+            return
+        parked = loads(batch)
+        if isinstance(parked, list):
+            # Parked before batches counted their attempts.
+            parked = {"attempts": 0, "rows": parked}
+        attempts, rows = parked["attempts"], [tuple(row) for row in parked["rows"]]
+        try:
+            await self._insert(rows)
+            log.info("Wrote %d buffered history rows", len(rows))
+        except Exception as e:
+            if unreachable(e):
+                log.warning("Database still unavailable: %s", e)
+                await self._client.lpush(HISTORY_BUFFER_KEY, batch)
+                return
+            attempts += 1
+            if not transient(e) or attempts >= settings.HISTORY_MAX_ATTEMPTS:
+                await self._dead_letter(rows, attempts, e)
+                return
+            log.warning("Buffered history batch failed (attempt %d): %s", attempts, e)
+            # To the back, so it does not hold up the batches parked behind it.
+            await self._client.rpush(HISTORY_BUFFER_KEY, dumps({"attempts": attempts, "rows": rows}))
+
+    async def _dead_letter(self, rows, attempts: int, error: Exception):
+        self.dead += 1
+        HISTORY_BATCHES_DEAD.inc()
+        if self._client is None:
+            log.error("Dropping %d history rows after %d attempts: %s", len(rows), attempts, error)
+            return
+        log.error("Dead-lettering %d history rows after %d attempts: %s", len(rows), attempts, error)
+        try:
+            await self._client.rpush(
+                HISTORY_DEAD_LETTER_KEY, dumps({"attempts": attempts, "error": str(error), "rows": rows})
+            )
+        except Exception:
+            log.exception("Could not dead-letter %d history rows, dropping them", len(rows))
+
+    def stop(self):
+        self._stopping = True
+        self._full.set()
+
+    async def run(self):
+        self._stopping = False
+        while True:
+            if len(self._rows) < settings.HISTORY_BATCH_SIZE and not self._stopping:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=settings.HISTORY_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                if self._rows:
+                    batch = [self._rows.popleft() for _ in range(min(len(self._rows), settings.HISTORY_BATCH_SIZE))]
+                    if not await self._flush(batch):
+                        if self._stopping:
+                            log.error("Dropping %d history rows at shutdown", len(self._rows))
+                            return
+                        await asyncio.sleep(settings.HISTORY_FLUSH_INTERVAL)
+                elif self._stopping:
+                    return
+                else:
+                    await self._drain_buffer()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("History flush failed")
+
+
+history = HistoryWriter(None if settings.STATE_BACKEND == "memory" else redis_client)
+HISTORY_ROWS_PENDING.set_function(history.pending)
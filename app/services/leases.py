@@ -0,0 +1,56 @@
+from uuid import uuid4
+
+# Takes the lease if it is free and extends it if we already hold it.
+# KEYS: lease key
+# ARGV: holder token, ttl_ms
+HOLD_LEASE = """
+local holder = redis.call('GET', KEYS[1])
+if not holder then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+if holder == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Gives the lease up, but only if we still hold it.
+# KEYS: lease key
+# ARGV: holder token
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Lease:
+    """A Redis key that at most one process holds at a time, expiring unless the holder keeps renewing it.
+    Without a client (STATE_BACKEND=memory) there is only this process, which always holds it."""
+
+    def __init__(self, client, key: str, ttl: float):
+        self.key = key
+        self.ttl_ms = int(ttl * 1000)
+        self.token = uuid4().hex
+        self.held = False
+        self._client = client
+        if client is not None:
+            self._hold = client.register_script(HOLD_LEASE)
+            self._release = client.register_script(RELEASE_LEASE)
+
+    async def hold(self):
+        if self._client is None:
+            self.held = True
+            return True
+        self.held = bool(await self._hold(keys=[self.key], args=[self.token, self.ttl_ms]))
+        return self.held
+
+    async def release(self):
+        if self.held and self._client is None:
+            self.held = False
+        elif self.held:
+            self.held = False
+            await self._release(keys=[self.key], args=[self.token])
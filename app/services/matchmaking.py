@@ -0,0 +1,156 @@
+import asyncio
+import random
+import time
+from collections import deque
+from uuid import uuid4
+from app.redis import redis_client
+from app.core.config import get_settings
+from app.core.keys import MATCHMAKERS_KEY, lease_key, wakeup_channel
+from app.core.log import get_logger
+from app.core.metrics import MATCHMAKING_QUEUE_WAIT, ROOMS_CREATED
+from app.services.leases import Lease
+from app.services.pubsub import hub
+
+settings = get_settings()
+log = get_logger("matchmaking")
+
+
+def room_sizes(count: int, min_size: int = None, max_size: int = None):
+    """Split `count` waiting players into as few rooms as possible, keeping sizes balanced."""
+    min_size = min_size or settings.MIN_ROOM_SIZE
+    max_size = max_size or settings.MAX_ROOM_SIZE
+    if count < min_size:
+        return []
+    rooms = -(-count // max_size)
+    while rooms > 1 and count // rooms < min_size:
+        rooms -= 1
+    base, extra = divmod(count, rooms)
+    return [base + 1 if i < extra else base for i in range(rooms)]
+
+
+class Matchmaker:
+    """Drains the pool shards this process holds the lease for; across all workers each shard has one matchmaker."""
+
+    def __init__(self, client, samples: int = 2048):
+        self._client = client
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._leases = [
+            Lease(client, lease_key(shard), settings.MATCHMAKING_LEASE_TTL)
+            for shard in range(settings.MATCHMAKING_SHARDS)
+        ]
+        self._wake_handlers = {}
+        self._token = uuid4().hex
+        self._waits = deque(maxlen=samples)
+        self.rooms_created = 0
+        self.players_matched = 0
+        self.passes = 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def held_shards(self):
+        return [shard for shard, lease in enumerate(self._leases) if lease.held]
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def record_waits(self, waits):
+        self._waits.extend(waits)
+        for wait in waits:
+            MATCHMAKING_QUEUE_WAIT.observe(wait)
+        self.players_matched += len(waits)
+        self.rooms_created += 1
+        ROOMS_CREATED.inc()
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            if not waits:
+                return None
+            return round(waits[min(len(waits) - 1, int(p / 100 * len(waits)))], 3)
+
+        return {
+            "held_shards": self.held_shards(),
+            "passes": self.passes,
+            "rooms_created": self.rooms_created,
+            "players_matched": self.players_matched,
+            "queue_wait_seconds": {
+                "samples": len(waits),
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": round(waits[-1], 3) if waits else None,
+            },
+        }
+
+    async def run(self, match):
+        self._stopping = False
+        for shard, lease in enumerate(self._leases):
+            # Joins on any worker publish a wake-up; only the shard's leader acts on it.
+            handler = self._wake_handlers[shard] = lambda frame, lease=lease: lease.held and self.wake()
+            await hub.subscribe(wakeup_channel(shard), handler)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.MATCHMAKING_IDLE_INTERVAL)
+                    # Give a burst of joins a moment to land so rooms fill up instead of starting at the minimum size.
+                    await asyncio.sleep(settings.MATCHMAKING_BATCH_WINDOW)
+                except asyncio.TimeoutError:
+                    pass
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                shards = await self._shards_to_try()
+                await asyncio.gather(*(self._pass(match, shard, self._leases[shard]) for shard in shards))
+        finally:
+            for shard, handler in self._wake_handlers.items():
+                await hub.unsubscribe(wakeup_channel(shard), handler)
+            self._wake_handlers.clear()
+            # Hand the shards over right away instead of making the next leader wait out the lease.
+            for lease in self._leases:
+                await lease.release()
+            if self._client is not None:
+                await self._client.zrem(MATCHMAKERS_KEY, self._token)
+
+    async def _shards_to_try(self):
+        # Every matchmaker heartbeats into a shared set and aims for its fair share of the shards,
+        # so shards spread over the live workers and move to the survivors when one goes away.
+        if self._client is None:
+            return list(range(len(self._leases)))
+        now = time.time()
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zadd(MATCHMAKERS_KEY, {self._token: now})
+            pipe.zremrangebyscore(MATCHMAKERS_KEY, "-inf", now - settings.MATCHMAKING_LEASE_TTL)
+            pipe.zcard(MATCHMAKERS_KEY)
+            _, _, live = await pipe.execute()
+        share = -(-len(self._leases) // max(live, 1))
+        held = self.held_shards()
+        if len(held) > share:
+            # Give one shard back per pass so a newcomer can pick it up.
+            await self._leases[held.pop()].release()
+        free = [shard for shard, lease in enumerate(self._leases) if not lease.held]
+        random.shuffle(free)
+        return held + free[:max(share - len(held), 0)]
+
+    async def _pass(self, match, shard: int, lease: Lease):
+        try:
+            # Holding renews the lease, and every pass renews well within MATCHMAKING_LEASE_TTL.
+            was_held = lease.held
+            if not await lease.hold():
+                if was_held:
+                    log.warning("Lost matchmaking lease for shard %d", shard)
+                return
+            if not was_held:
+                log.info("Took matchmaking lease for shard %d", shard)
+            self.passes += 1
+            await match(shard)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Matchmaking pass failed for shard %d", shard)
+
+
+matchmaker = Matchmaker(None if settings.STATE_BACKEND == "memory" else redis_client)
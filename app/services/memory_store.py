@@ -0,0 +1,402 @@
+import abc
+import heapq
+import time
+from collections import deque
+from operator import itemgetter
+from app.core.codec import Frame
+from app.core.config import get_settings
+from app.core.keys import shard_of, room_channel, wakeup_channel
+from app.services.events import ENDED_ROOM_EVENTS_TTL_MS, with_id, parse_event_id
+from app.services.pubsub import hub, encode_event
+from app.services.room_index import INDEXED_STATUSES
+from app.services.store import GameStore, MATCH_RATE_BUCKET, ROOM_TTL, rate_buckets
+
+settings = get_settings()
+
+
+class Room:
+    __slots__ = (
+        "players", "alive", "spy", "secret_location", "status", "current_turn", "started_at", "round", "ballots",
+        "ballot", "questions", "connected", "game_started", "expires_at",
+    )
+
+    def __init__(self, players, spy: int, secret_location: str, now: float):
+        self.players = players
+        self.alive = list(range(len(players)))
+        self.spy = spy
+        self.secret_location = secret_location
+        self.status = "active"
+        self.current_turn = 0
+        self.started_at = now
+        self.round = 1
+        self.ballots = 0
+        self.ballot = {}
+        self.questions = []
+        self.connected = set()
+        self.game_started = False
+        self.expires_at = now + ROOM_TTL
+
+    def names(self):
+        return [self.players[index] for index in self.alive]
+
+    def previous_question(self):
+        return self.questions[-1][1] if self.questions else None
+
+    def question_records(self):
+        return [
+            {"player": self.players[index], "answer": answer, "question": question}
+            for index, question, answer in self.questions
+        ]
+
+    def game(self):
+        """What close_room returns for the game history."""
+        return {
+            "players": self.players,
+            "alive": self.names(),
+            "spy": self.players[self.spy],
+            "secret_location": self.secret_location,
+            "started_at": self.started_at,
+            "round": self.round,
+            "questions": self.question_records(),
+        }
+
+    def snapshot(self):
+        """The room as a JSON-able list of its fields, in __slots__ order."""
+        snapshot = [getattr(self, field) for field in self.__slots__]
+        snapshot[self.__slots__.index("ballot")] = list(self.ballot.items())
+        snapshot[self.__slots__.index("connected")] = list(self.connected)
+        return snapshot
+
+    @classmethod
+    def restore(cls, snapshot):
+        room = cls.__new__(cls)
+        for field, value in zip(cls.__slots__, snapshot):
+            setattr(room, field, value)
+        room.ballot = dict(room.ballot)
+        room.questions = [tuple(entry) for entry in room.questions]
+        room.connected = set(room.connected)
+        return room
+
+
+class LocalRooms(abc.ABC):
+    """The room methods of GameStore over Room objects held in this process. Every method runs without
+    awaiting in between, so each is as atomic as the Redis script it mirrors; the rules (turn order, ballots,
+    tallies) are the same as in app.services.scripts. Subclasses provide _expired(), and _changed() to hear
+    about every change to a room."""
+
+    def __init__(self):
+        self._rooms = {}
+
+    def _room(self, room_id: str):
+        room = self._rooms.get(room_id)
+        if room is not None and room.expires_at <= time.time():
+            self._expired(room_id)
+            return None
+        return room
+
+    @abc.abstractmethod
+    def _expired(self, room_id: str):
+        raise NotImplementedError
+
+    def _changed(self, room_id: str):
+        pass
+
+
+    async def room_exists(self, room_id: str):
+        return self._room(room_id) is not None
+
+    async def room_state(self, room_id: str):
+        room = self._room(room_id)
+        if room is None:
+            return None
+        return (
+            room.status, room.current_turn, room.players, room.names(), room.players[room.spy],
+            room.secret_location,
+        )
+
+    async def connect(self, room_id: str, index: int):
+        room = self._room(room_id)
+        if room is None:
+            return 0
+        room.connected.add(index)
+        self._changed(room_id)
+        return len(room.connected)
+
+    async def disconnect(self, room_id: str, index: int):
+        room = self._room(room_id)
+        if room is not None:
+            room.connected.discard(index)
+            self._changed(room_id)
+
+    async def start_game(self, room_id: str):
+        room = self._room(room_id)
+        if room is None or room.game_started:
+            return False
+        room.game_started = True
+        self._changed(room_id)
+        return True
+
+    async def turn_state(self, room_id: str):
+        room = self._room(room_id)
+        if room is None:
+            return None
+        return room.status, room.names(), room.previous_question()
+
+    async def previous_question(self, room_id: str):
+        room = self._room(room_id)
+        return room.previous_question() if room is not None else None
+
+    async def advance_turn(self, room_id: str, expected_turn, player: str, question: str, answer: str):
+        room = self._room(room_id)
+        if room is None or room.status != "active":
+            return None
+        turn = room.current_turn
+        if expected_turn is not None and turn != expected_turn:
+            return None
+        if player:
+            if turn >= len(room.alive) or room.players[room.alive[turn]] != player:
+                return None
+            room.questions.append((room.alive[turn], question, answer))
+        self._changed(room_id)
+        room.current_turn = turn + 1
+        if room.current_turn >= len(room.alive):
+            room.status = "voting"
+            return ("voting",)
+        return "turn", room.current_turn, room.names(), room.previous_question()
+
+    async def cast_vote(self, room_id: str, voter: str, voted_for: str):
+        room = self._room(room_id)
+        if room is None or room.status != "voting" or voter not in room.players:
+            return None
+        index = room.players.index(voter)
+        if index not in room.alive:
+            return None
+        room.ballot[index] = room.players.index(voted_for) if voted_for in room.players else None
+        self._changed(room_id)
+        if any(index not in room.ballot for index in room.alive):
+            return ("cast",)
+        return ("cast", *self._tally(room))
+
+    async def process_votes(self, room_id: str):
+        room = self._room(room_id)
+        if room is None or room.status != "voting":
+            return None
+        self._changed(room_id)
+        return self._tally(room)
+
+    def _tally(self, room: Room):
+        counts = dict.fromkeys(room.alive, 0)
+        votes = []
+        for voter, voted in sorted(room.ballot.items()):
+            if voted in counts:
+                counts[voted] += 1
+            votes.append((room.players[voter], room.players[voted] if voted is not None else None))
+        most = max(counts.values(), default=0)
+        top = [index for index in room.alive if counts[index] == most]
+        number = room.ballots + 1
+        room.ballot = {}
+        if len(top) != 1:
+            room.ballots = number
+            return "tie", (room.round, number, votes, None)
+        record = (room.round, number, votes, room.question_records())
+        room.questions = []
+        room.round += 1
+        room.ballots = 0
+        spy = room.players[room.spy]
+        voted = top[0]
+        if voted == room.spy:
+            room.status = "ended"
+            return "players_win", spy, record
+        room.alive.remove(voted)
+        room.current_turn = 0
+        room.status = "active" if len(room.alive) > 2 else "ended"
+        return "eliminated", spy, room.players[voted], len(room.alive), record
+
+    async def end_game(self, room_id: str, *statuses: str):
+        room = self._room(room_id)
+        if room is None or room.status not in statuses:
+            return None
+        room.status = "ended"
+        self._changed(room_id)
+        return room.players[room.spy]
+
+    async def leave_room(self, room_id: str, player: str):
+        room = self._room(room_id)
+        if room is None or player not in room.players:
+            return None
+        index = room.players.index(player)
+        if index not in room.alive:
+            return None
+        room.alive.remove(index)
+        if room.current_turn >= len(room.alive):
+            room.current_turn = 0
+        self._changed(room_id)
+        return len(room.alive)
+
+
+class MemoryGameStore(LocalRooms, GameStore):
+    """The whole game state in this process, for a single worker without Redis (STATE_BACKEND=memory)."""
+
+    def __init__(self):
+        super().__init__()
+        self._pools = [{} for _ in range(settings.MATCHMAKING_SHARDS)]
+        self._placed = [{} for _ in range(settings.MATCHMAKING_SHARDS)]
+        self._assigned = {}
+        self._indexed = {status: set() for status in INDEXED_STATUSES}
+        self._deadlines = {}
+        self._players_in_game = 0
+        # room_id -> [events as (parsed id, id, encoded event), last id, expiry of the log once the room is gone]
+        self._events = {}
+        self._ended = deque()
+
+    def _expired(self, room_id: str):
+        self._drop(room_id)
+
+    def _drop(self, room_id: str):
+        room = self._rooms.pop(room_id)
+        removed = False
+        for status in INDEXED_STATUSES:
+            if room_id in self._indexed[status]:
+                self._indexed[status].discard(room_id)
+                removed = True
+        self._deadlines.pop(room_id, None)
+        if removed:
+            self._players_in_game -= len(room.alive)
+        for player in room.players:
+            if self._assigned.get(player) == room_id:
+                del self._assigned[player]
+        self._end_events(room_id)
+        return room
+
+    def _end_events(self, room_id: str):
+        # Like the stream, the log outlives its room by a minute, so the closing events can be caught up on.
+        log = self._events.get(room_id)
+        if log is not None and log[2] is None:
+            log[2] = time.time() + ENDED_ROOM_EVENTS_TTL_MS / 1000
+            self._ended.append((log[2], room_id))
+
+    async def join_pool(self, username: str):
+        shard = shard_of(username)
+        self._pools[shard].setdefault(username, time.time())
+        await hub.publish((wakeup_channel(shard), ""))
+
+    async def leave_pool(self, username: str):
+        return self._pools[shard_of(username)].pop(username, None) is not None
+
+    async def pool_size(self, shard: int):
+        return len(self._pools[shard])
+
+    async def queue_position(self, username: str):
+        pool = self._pools[shard_of(username)]
+        joined_at = pool.get(username)
+        rank = None
+        if joined_at is not None:
+            rank = sum(1 for player, joined in pool.items() if (joined, player) < (joined_at, username))
+        placed = self._placed[shard_of(username)]
+        return rank, joined_at, len(pool), sum(placed.get(bucket, 0) for bucket in rate_buckets(time.time()))
+
+    async def claim_players(self, shard: int, room_id: str, size: int):
+        pool = self._pools[shard]
+        popped = heapq.nsmallest(size, pool.items(), key=itemgetter(1, 0))
+        for player, _ in popped:
+            del pool[player]
+        claimed = [(player, joined) for player, joined in popped if player not in self._assigned]
+        if len(claimed) < settings.MIN_ROOM_SIZE:
+            pool.update(claimed)
+            return None
+        for player, _ in claimed:
+            self._assigned[player] = room_id
+        return [player for player, _ in claimed], [joined for _, joined in claimed]
+
+    async def create_room(self, room_id: str, shard: int, players, spy: int, secret_location: str, now: float):
+        self._rooms[room_id] = Room(players, spy, secret_location, now)
+        self._indexed["active"].add(room_id)
+        self._deadlines[room_id] = now + settings.GAME_TIMEOUT
+        self._players_in_game += len(players)
+        placed = self._placed[shard]
+        buckets = rate_buckets(now)
+        for bucket in [bucket for bucket in placed if bucket < buckets.start]:
+            del placed[bucket]
+        bucket = int(now // MATCH_RATE_BUCKET)
+        placed[bucket] = placed.get(bucket, 0) + len(players)
+
+    async def assigned_room(self, username: str):
+        return self._assigned.get(username)
+
+    async def clear_assignment(self, username: str):
+        self._assigned.pop(username, None)
+
+    async def move_room(self, room_id: str, previous: str, status: str):
+        if room_id in self._indexed[previous]:
+            self._indexed[previous].discard(room_id)
+            self._indexed[status].add(room_id)
+
+    async def player_left(self, room_id: str, reopened: bool = False):
+        self._players_in_game -= 1
+        if reopened:
+            await self.move_room(room_id, "voting", "active")
+
+    async def close_room(self, room_id: str):
+        if room_id not in self._rooms:
+            return None
+        return self._drop(room_id).game()
+
+    async def append_event(self, room_id: str, event: dict):
+        now = time.time()
+        while self._ended and self._ended[0][0] <= now:
+            _, ended = self._ended.popleft()
+            log = self._events.get(ended)
+            if log is not None and log[2] is not None and log[2] <= now:
+                del self._events[ended]
+        log = self._events.get(room_id)
+        if log is None:
+            log = self._events[room_id] = [deque(maxlen=settings.ROOM_EVENTS_MAXLEN), (0, 0), None]
+            if room_id not in self._rooms:
+                self._end_events(room_id)
+        # Ids in the same "<ms>-<seq>" form as Redis stream ids, so clients cannot tell the backends apart.
+        ms = int(now * 1000)
+        last = log[1]
+        parsed = (ms, 0) if ms > last[0] else (last[0], last[1] + 1)
+        event_id = f"{parsed[0]}-{parsed[1]}"
+        encoded = encode_event(event)
+        log[0].append((parsed, event_id, encoded))
+        log[1] = parsed
+        await hub.publish((room_channel(room_id), with_id(event_id, encoded)))
+        return event_id
+
+    async def events_since(self, room_id: str, last_event_id: str):
+        after = parse_event_id(last_event_id)
+        log = self._events.get(room_id)
+        if after is None or log is None:
+            return None
+        entries = log[0]
+        for position, (parsed, _, _) in enumerate(entries):
+            if parsed == after:
+                return [
+                    Frame(with_id(event_id, encoded))
+                    for _, event_id, encoded in list(entries)[position + 1:]
+                ]
+            if parsed > after:
+                break
+        return None
+
+    async def live_stats(self, ending_within: float, limit: int = 20):
+        now = time.time()
+        ending = [
+            (deadline, room_id) for room_id, deadline in self._deadlines.items()
+            if now <= deadline <= now + ending_within
+        ]
+        shards = [len(pool) for pool in self._pools]
+        return {
+            "pool": {"waiting": sum(shards), "shards": shards},
+            "rooms": {status: len(self._indexed[status]) for status in INDEXED_STATUSES},
+            "players_in_game": self._players_in_game,
+            "ending_soon": {
+                "within_seconds": ending_within,
+                "rooms": len(ending),
+                "soonest": [
+                    {"room_id": room_id, "seconds_left": round(deadline - now, 1)}
+                    for deadline, room_id in heapq.nsmallest(limit, ending)
+                ],
+            },
+        }
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from collections import deque
+from fastapi import WebSocket
+from app.core.codec import Frame
+from app.core.config import get_settings
+from app.core.log import get_logger
+from app.core.metrics import WS_SEND_LAG_SECONDS, WS_FRAMES_SHED, WS_SLOW_CLIENTS, WS_SLOW_DISCONNECTS
+from app.services.events import parse_event_id
+
+settings = get_settings()
+log = get_logger("ws")
+
+# When a socket's queue is full: these are dropped outright,
+DROPPED_WHEN_FULL = {"vote_cast"}
+# queued ones of these are superseded by the incoming one,
+COALESCED_WHEN_FULL = {"turn"}
+# and if that still leaves no room the socket is closed with this code; it can resume with last_event_id.
+SLOW_CLIENT_CLOSE_CODE = 4008
+
+_open = set()
+
+
+def _kind(frame: Frame):
+    return frame.data.get("type")
+
+
+class Outbox:
+    """Bounded send queue of one socket, drained by its own writer task so a slow client
+    never holds up the hub or the other sockets."""
+
+    def __init__(self, websocket: WebSocket, wire, endpoint: str, **context):
+        self.websocket = websocket
+        self.wire = wire
+        self.endpoint = endpoint
+        self.context = context
+        self.closed = False
+        self.sent = 0
+        self.shed = 0
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        self._task = None
+        self._closing = None
+
+    def start(self, after: str = None):
+        _open.add(self)
+        self._task = asyncio.create_task(self._run(after))
+        return self._task
+
+    def close(self):
+        self.closed = True
+        _open.discard(self)
+        if self._task is not None:
+            self._task.cancel()
+
+    def put(self, frame: Frame):
+        if self.closed:
+            return
+        if len(self._frames) >= settings.WS_SEND_QUEUE_SIZE:
+            kind = _kind(frame)
+            if kind in DROPPED_WHEN_FULL:
+                self._count_shed("dropped", 1)
+                return
+            self._make_room(kind)
+            if len(self._frames) >= settings.WS_SEND_QUEUE_SIZE:
+                self._overflow()
+                return
+        self._frames.append((frame, time.monotonic()))
+        self._ready.set()
+
+    def _make_room(self, kind):
+        kept = deque()
+        dropped = coalesced = 0
+        for item in self._frames:
+            queued = _kind(item[0])
+            if queued in DROPPED_WHEN_FULL:
+                dropped += 1
+            elif queued == kind and kind in COALESCED_WHEN_FULL:
+                coalesced += 1
+            else:
+                kept.append(item)
+        self._frames = kept
+        self._count_shed("dropped", dropped)
+        self._count_shed("coalesced", coalesced)
+
+    def _count_shed(self, reason: str, count: int):
+        if count:
+            self.shed += count
+            WS_FRAMES_SHED.labels(self.endpoint, reason).inc(count)
+
+    def _overflow(self):
+        log.warning("Closing slow socket with %d frames queued", len(self._frames), extra=self.context)
+        WS_SLOW_DISCONNECTS.labels(self.endpoint).inc()
+        self._frames.clear()
+        self.close()
+        self._closing = asyncio.create_task(self._close())
+
+    async def _close(self):
+        try:
+            await self.websocket.close(code=SLOW_CLIENT_CLOSE_CODE)
+        except Exception:
+            pass
+
+    async def _run(self, after):
+        after = parse_event_id(after) if after else None
+        while True:
+            if not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            frame, queued_at = self._frames.popleft()
+            if after is not None:
+                # Skip what the reconnect catch-up already sent; event ids only grow, so stop at the first newer one.
+                event_id = parse_event_id(frame.data.get("event_id"))
+                if event_id is not None and event_id <= after:
+                    continue
+                after = None
+            await self.wire.send(self.websocket, frame)
+            WS_SEND_LAG_SECONDS.labels(self.endpoint).observe(time.monotonic() - queued_at)
+            self.sent += 1
+
+    def stats(self, now: float):
+        return {
+            "endpoint": self.endpoint,
+            **self.context,
+            "queued": len(self._frames),
+            "oldest_seconds": round(now - self._frames[0][1], 3) if self._frames else 0.0,
+            "sent": self.sent,
+            "shed": self.shed,
+        }
+
+
+def slow_clients(limit: int = 50):
+    """The most backed-up sockets on this worker, deepest queue first."""
+    now = time.monotonic()
+    slow = [outbox for outbox in _open if len(outbox._frames) >= settings.WS_SLOW_CLIENT_DEPTH]
+    slow.sort(key=lambda outbox: len(outbox._frames), reverse=True)
+    return [outbox.stats(now) for outbox in slow[:limit]]
+
+
+def slow_client_count(endpoint: str):
+    return sum(
+        1 for outbox in _open
+        if outbox.endpoint == endpoint and len(outbox._frames) >= settings.WS_SLOW_CLIENT_DEPTH
+    )
+
+
+for endpoint in ("user", "room"):
+    WS_SLOW_CLIENTS.labels(endpoint).set_function(lambda endpoint=endpoint: slow_client_count(endpoint))
@@ -0,0 +1,188 @@
+import math
+import time
+from uuid import uuid4
+from app.redis import run_scripts
+from app.core.codec import dumps, loads
+from app.core.config import get_settings
+from app.core.keys import room_key, assigned_key, matched_key, worker_rooms_key, ROOM_WORKERS_KEY
+from app.services.memory_store import LocalRooms, Room
+from app.services.room_index import index_room, unindex_room
+from app.services.store import RedisGameStore, MATCH_RATE_BUCKET
+from app.services.timers import timers
+
+settings = get_settings()
+
+# With STATE_BACKEND=owned a room's hash holds only its owner's token (`owner`) and its last snapshot
+# (`snapshot`): the Room's fields and pending timers, written by the owner. The hash keeps the room's TTL,
+# so the event stream still follows it. Each worker also lists the rooms it owns in worker_rooms:{<token>},
+# and room_workers lists the workers that have such a list, so the rooms of a worker that is gone can be found.
+
+# Rooms of a worker that is gone taken over per sweep; whatever is left waits for the next one.
+ADOPT_BATCH = 100
+
+# Saves a snapshot unless another worker has taken the room over (or it is gone).
+# KEYS: room:{<id>}
+# ARGV: owner token, snapshot
+SAVE_SNAPSHOT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'snapshot', ARGV[2])
+return 1
+"""
+
+# Hands the room to a new owner if it still belongs to the given one, and returns its snapshot.
+# KEYS: room:{<id>}
+# ARGV: previous owner token, new owner token
+TAKE_OVER = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return false
+end
+redis.call('HSET', KEYS[1], 'owner', ARGV[2])
+return redis.call('HGET', KEYS[1], 'snapshot')
+"""
+
+
+class OwnedGameStore(LocalRooms, RedisGameStore):
+    """Each room in the memory of the worker that owns it (STATE_BACKEND=owned), with the pool, assignments,
+    events and indexes in Redis as for RedisGameStore. The room methods only see this worker's rooms;
+    app.services.ownership runs every room action on its owner. Changed rooms are saved every
+    ROOM_SNAPSHOT_INTERVAL for whichever worker takes them over."""
+
+    def __init__(self, client):
+        LocalRooms.__init__(self)
+        RedisGameStore.__init__(self, client)
+        self.token = uuid4().hex
+        self._dirty = set()
+        self._save = client.register_script(SAVE_SNAPSHOT)
+        self._take_over = client.register_script(TAKE_OVER)
+        self.snapshots = 0
+        self.taken_over = 0
+        # Timers live with their room, so a change to them is a change to the room.
+        timers.changed = self._changed
+
+    def _expired(self, room_id: str):
+        # The hash expires on its own.
+        del self._rooms[room_id]
+        self._dirty.discard(room_id)
+
+    def _changed(self, room_id: str):
+        if room_id in self._rooms:
+            self._dirty.add(room_id)
+
+    def _snapshot(self, room_id: str, room: Room):
+        return dumps([room.snapshot(), timers.pending(room_id)])
+
+    def owns(self, room_id: str):
+        return room_id in self._rooms
+
+    async def owner_of(self, room_id: str):
+        owner = await self._client.hget(room_key(room_id), "owner")
+        return owner.decode() if owner else None
+
+    async def create_room(self, room_id: str, shard: int, players, spy: int, secret_location: str, now: float):
+        room = self._rooms[room_id] = Room(players, spy, secret_location, now)
+        rate_key = matched_key(shard, int(now // MATCH_RATE_BUCKET))
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.hset(room_key(room_id), mapping={"owner": self.token, "snapshot": self._snapshot(room_id, room)})
+            pipe.expire(room_key(room_id), math.ceil(room.expires_at - now))
+            self._list_owned(pipe, room_id)
+            index_room(pipe, room_id, len(players), now + settings.GAME_TIMEOUT)
+            pipe.incrby(rate_key, len(players))
+            pipe.expire(rate_key, settings.MATCHMAKING_RATE_WINDOW + MATCH_RATE_BUCKET)
+            await pipe.execute()
+
+    async def room_exists(self, room_id: str):
+        if room_id in self._rooms:
+            return self._room(room_id) is not None
+        return await RedisGameStore.room_exists(self, room_id)
+
+    async def close_room(self, room_id: str):
+        room = self._rooms.pop(room_id, None)
+        self._dirty.discard(room_id)
+        if room is None:
+            return None
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.delete(room_key(room_id))
+            pipe.srem(worker_rooms_key(self.token), room_id)
+            for player in room.players:
+                pipe.hdel(assigned_key(player), player)
+            await pipe.execute()
+        await unindex_room(self._client, room_id, len(room.alive))
+        return room.game()
+
+    async def save_snapshots(self):
+        """Saves the rooms changed since the last call; returns those another worker has taken over meanwhile,
+        which this one has to let go of."""
+        rooms = [room_id for room_id in self._dirty if room_id in self._rooms]
+        self._dirty.clear()
+        if not rooms:
+            return []
+        try:
+            saved = await run_scripts([
+                (self._save, [room_key(room_id)], [self.token, self._snapshot(room_id, self._rooms[room_id])])
+                for room_id in rooms
+            ])
+        except Exception:
+            self._dirty.update(rooms)
+            raise
+        self.snapshots += len(rooms)
+        return [room_id for room_id, ok in zip(rooms, saved) if not ok]
+
+    async def take_over(self, room_id: str, previous: str):
+        """Makes this worker the room's owner if it still belongs to previous, restoring its last snapshot
+        and restarting its timers."""
+        snapshot = await self._take_over(keys=[room_key(room_id)], args=[previous, self.token])
+        if not snapshot:
+            return False
+        room, pending = loads(snapshot)
+        self._rooms[room_id] = Room.restore(room)
+        self.taken_over += 1
+        for kind, due, args in pending:
+            await timers.schedule(kind, room_id, max(due - time.time(), 0), **args)
+        async with self._client.pipeline(transaction=False) as pipe:
+            self._list_owned(pipe, room_id)
+            await pipe.execute()
+        return True
+
+    def _list_owned(self, pipe, room_id: str):
+        pipe.sadd(worker_rooms_key(self.token), room_id)
+        pipe.sadd(ROOM_WORKERS_KEY, self.token)
+
+    async def room_workers(self):
+        """Tokens of the workers that have owned rooms, this one included."""
+        return [token.decode() for token in await self._client.smembers(ROOM_WORKERS_KEY)]
+
+    async def adopt(self, previous: str):
+        """Takes over up to ADOPT_BATCH rooms listed for a worker that is gone; returns how many it got.
+        A room that is gone or already taken over by someone else is just struck off the list."""
+        key = worker_rooms_key(previous)
+        room_ids = [room_id.decode() for room_id in await self._client.srandmember(key, ADOPT_BATCH)]
+        taken = 0
+        for room_id in room_ids:
+            taken += await self.take_over(room_id, previous)
+        async with self._client.pipeline(transaction=False) as pipe:
+            if room_ids:
+                pipe.srem(key, *room_ids)
+            pipe.scard(key)
+            left = (await pipe.execute())[-1]
+        if not left:
+            await self._client.srem(ROOM_WORKERS_KEY, previous)
+        return taken
+
+    def release(self, *room_ids: str):
+        """Forgets the rooms (all of them if none are given) without saving them, as they belong to another
+        worker now; returns their ids."""
+        room_ids = room_ids or list(self._rooms)
+        for room_id in room_ids:
+            self._rooms.pop(room_id, None)
+            self._dirty.discard(room_id)
+        return room_ids
+
+    def stats(self):
+        return {
+            "rooms": len(self._rooms),
+            "unsaved": len(self._dirty),
+            "snapshots": self.snapshots,
+            "taken_over": self.taken_over,
+        }
@@ -0,0 +1,198 @@
+import asyncio
+import functools
+import itertools
+import time
+from app.redis import redis_client
+from app.core.codec import dumps
+from app.core.config import get_settings
+from app.core.keys import worker_channel, worker_lease_key
+from app.core.log import get_logger
+from app.services.leases import Lease
+from app.services.pubsub import hub
+from app.services.store import store
+from app.services.timers import timers
+
+settings = get_settings()
+log = get_logger("ownership")
+
+# How many ROOM_FORWARD_TIMEOUTs a forwarded action waits for an owner whose lease is still live.
+FORWARD_WAITS = 3
+
+
+class RoomBusy(Exception):
+    """The room's owner is alive but has not answered a forwarded action; the caller may try again."""
+
+
+class RoomOwnership:
+    """Runs every room action on the worker that owns the room (STATE_BACKEND=owned). The owner is the worker
+    that created the room, recorded in the room's hash; it holds the room in memory (OwnedGameStore) and fires
+    its timers. Other workers forward actions over the owner's worker channel and get the result back on theirs.
+    A worker owns its rooms only while it renews its lease: once that expires, the next action on one of its
+    rooms takes the room over from the last snapshot, and so does a sweep every ROOM_OWNER_LEASE_TTL, so the rooms'
+    timers fire again even if no player acts."""
+
+    def __init__(self, client):
+        self.token = store.token
+        self.channel = worker_channel(self.token)
+        self.lease = Lease(client, worker_lease_key(self.token), settings.ROOM_OWNER_LEASE_TTL)
+        self.actions = {}
+        self._client = client
+        self._calls = {}
+        self._ids = itertools.count()
+        self._serving = set()
+        self._renewed = 0.0
+        self._swept = 0.0
+        self._stopping = asyncio.Event()
+        self.forwarded = 0
+        self.served = 0
+
+    def action(self, func):
+        """Registers a coroutine function taking the room id first; calls to the result run on the room's owner.
+        Arguments and results cross the worker channel as JSON."""
+        self.actions[func.__name__] = func
+
+        @functools.wraps(func)
+        async def call(room_id: str, *args):
+            return await self.call(func.__name__, room_id, *args)
+        return call
+
+    async def call(self, name: str, room_id: str, *args):
+        # Twice at most: a takeover lost to another worker leaves the room with that one.
+        for _ in range(2):
+            if store.owns(room_id):
+                break
+            owner = await store.owner_of(room_id)
+            if owner is None:
+                # Gone; run here, where the action finds no room.
+                break
+            if owner != self.token:
+                try:
+                    return await self._forward(owner, name, room_id, args)
+                except asyncio.TimeoutError:
+                    log.warning("Owner of room %s is gone, taking it over", room_id, extra={"room_id": room_id})
+            if await store.take_over(room_id, owner):
+                break
+        return await self.actions[name](room_id, *args)
+
+    async def _forward(self, owner: str, name: str, room_id: str, args):
+        """Sends the action to the owner once and waits for its reply while the owner's lease is live, so a slow
+        owner never runs it twice. Raises asyncio.TimeoutError once the lease is gone, RoomBusy if it never is."""
+        call_id = next(self._ids)
+        reply = self._calls[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            await hub.publish((worker_channel(owner), dumps({
+                "call": call_id, "reply_to": self.token, "action": name, "room_id": room_id, "args": args,
+            })))
+            self.forwarded += 1
+            for _ in range(FORWARD_WAITS):
+                try:
+                    return await asyncio.wait_for(asyncio.shield(reply), settings.ROOM_FORWARD_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if not await self._client.exists(worker_lease_key(owner)):
+                        raise
+            raise RoomBusy(f"Owner of room {room_id} did not answer {name}")
+        finally:
+            self._calls.pop(call_id, None)
+
+    def _receive(self, frame):
+        message = frame.data
+        if "reply" in message:
+            reply = self._calls.get(message["reply"])
+            if reply is not None and not reply.done():
+                if "error" in message:
+                    reply.set_exception(RuntimeError(f"Owner failed: {message['error']}"))
+                else:
+                    reply.set_result(message["result"])
+            return
+        task = asyncio.create_task(self._serve(message))
+        self._serving.add(task)
+        task.add_done_callback(self._serving.discard)
+
+    async def _serve(self, message: dict):
+        # Routed again, in case this worker has let go of the room since the caller looked its owner up.
+        reply = {"reply": message["call"]}
+        try:
+            reply["result"] = await self.call(message["action"], message["room_id"], *message["args"])
+        except Exception as e:
+            log.exception("Forwarded %s failed", message["action"], extra={"room_id": message["room_id"]})
+            reply["error"] = str(e)
+        self.served += 1
+        await hub.publish((worker_channel(message["reply_to"]), dumps(reply)))
+
+    async def start(self):
+        """Takes the lease and opens the worker channel; before this worker creates or takes over any room."""
+        await self.lease.hold()
+        self._renewed = time.monotonic()
+        await hub.subscribe(self.channel, self._receive)
+
+    def stop(self):
+        self._stopping.set()
+
+    async def _release(self, *room_ids: str):
+        for room_id in store.release(*room_ids):
+            await timers.cancel(room_id)
+
+    async def run(self):
+        """Saves changed rooms and renews the lease until stopped; then saves them a last time and lets go of
+        the lease so the other workers take the rooms over at their next sweep."""
+        self._stopping.clear()
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=settings.ROOM_SNAPSHOT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                lost = await store.save_snapshots()
+                if lost:
+                    log.warning("Rooms %s were taken over by other workers", lost)
+                    await self._release(*lost)
+                if time.monotonic() - self._renewed > settings.ROOM_OWNER_LEASE_TTL / 3:
+                    lapsed = time.monotonic() - self._renewed > settings.ROOM_OWNER_LEASE_TTL
+                    await self.lease.hold()
+                    self._renewed = time.monotonic()
+                    if lapsed:
+                        # Anyone may have taken the rooms over while the lease was gone.
+                        log.warning("Ownership lease lapsed, letting go of all rooms")
+                        await self._release()
+                # After the renewal, so rooms taken over here are not let go of again with a lapsed lease.
+                if time.monotonic() - self._swept > settings.ROOM_OWNER_LEASE_TTL:
+                    self._swept = time.monotonic()
+                    await self._sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Room snapshot, lease renewal or sweep failed")
+        await hub.unsubscribe(self.channel, self._receive)
+        try:
+            await store.save_snapshots()
+        finally:
+            await self.lease.release()
+
+    async def _sweep(self):
+        # Each sweeping worker takes a random batch of the orphans, so they spread over the survivors;
+        # the takeover script makes sure every room goes to exactly one of them.
+        for worker in await store.room_workers():
+            if worker == self.token or await self._client.exists(worker_lease_key(worker)):
+                continue
+            taken = await store.adopt(worker)
+            if taken:
+                log.warning("Took over %d rooms of worker %s, whose lease has expired", taken, worker)
+
+    def stats(self):
+        return {
+            "worker": self.token,
+            **store.stats(),
+            "forwarded": self.forwarded,
+            "served": self.served,
+            "pending_calls": len(self._calls),
+        }
+
+
+ownership = RoomOwnership(redis_client) if settings.STATE_BACKEND == "owned" else None
+
+
+def room_action(func):
+    """Decorator for the game actions on one room: with STATE_BACKEND=owned they run on the room's owner."""
+    if ownership is None:
+        return func
+    return ownership.action(func)
@@ -0,0 +1,325 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+import redis.asyncio as redis
+from redis.asyncio.client import PubSub
+from app.redis import redis_client
+from app.core.codec import Frame, dumps
+from app.core.config import get_settings
+from app.core.log import get_logger
+from app.core.metrics import PUBSUB_LAG_SECONDS
+
+settings = get_settings()
+log = get_logger("pubsub")
+
+SENT_AT = '"sent_at":'
+
+
+def encode_event(event: dict) -> str:
+    # Stamped last with the publish time so the receiving hub can measure delivery lag without parsing.
+    event["sent_at"] = round(time.time(), 6)
+    return dumps(event)
+
+
+def publish(client, channel: str, message: str):
+    """Publishes through a client or pipeline. In cluster mode this is SPUBLISH, which only reaches the
+    node owning the channel's slot instead of being broadcast over the whole cluster bus. The cluster client and
+    its pipeline have no spublish(), so it goes out as a raw command, routed by the channel's slot."""
+    if settings.REDIS_CLUSTER:
+        return client.execute_command("SPUBLISH", channel, message)
+    return client.publish(channel, message)
+
+
+class ShardedPubSub(PubSub):
+    """PubSub whose channels are shard channels (SSUBSCRIBE); the asyncio client has no sharded pub/sub of its own."""
+
+    PUBLISH_MESSAGE_TYPES = ("message", "pmessage", "smessage")
+    UNSUBSCRIBE_MESSAGE_TYPES = ("unsubscribe", "punsubscribe", "sunsubscribe")
+
+    async def subscribe(self, *args, **kwargs):
+        # Also called by on_connect to restore the subscriptions after a reconnect.
+        channels = dict.fromkeys(args)
+        channels.update(kwargs)
+        await self.execute_command("SSUBSCRIBE", *channels)
+        channels = self._normalize_keys(channels)
+        self.channels.update(channels)
+        self.pending_unsubscribe_channels.difference_update(channels)
+
+    def unsubscribe(self, *args):
+        self.pending_unsubscribe_channels.update(self._normalize_keys(dict.fromkeys(args)))
+        return self.execute_command("SUNSUBSCRIBE", *args)
+
+
+class Waiters:
+    """Requests parked on one channel until its next message; a single hub handler wakes them all."""
+
+    def __init__(self):
+        self.futures = set()
+
+    def __call__(self, frame: Frame):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(frame)
+        self.futures.clear()
+
+
+class Hub:
+    """Fans each channel's messages out to its local subscribers; subclasses decide where the messages come from."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._waiters = {}
+
+    def subscriber_count(self, channel: str):
+        return len(self._handlers.get(channel, ()))
+
+    def stats(self):
+        return {
+            "channels": len(self._handlers),
+            "subscribers": sum(len(handlers) for handlers in self._handlers.values()),
+            "waiters": sum(len(waiters.futures) for waiters in self._waiters.values()),
+        }
+
+    @asynccontextmanager
+    async def waiter(self, channel: str):
+        """Yields a future resolved with the next frame published on channel. The channel is subscribed
+        on entry, so the caller can check the current state first without missing a message in between."""
+        future = asyncio.get_running_loop().create_future()
+        waiters = self._waiters.get(channel)
+        if waiters is None:
+            waiters = self._waiters[channel] = Waiters()
+        waiters.futures.add(future)
+        try:
+            # Returns at once if another waiter already subscribed the channel, but only after it is live.
+            await self.subscribe(channel, waiters)
+            yield future
+        finally:
+            waiters.futures.discard(future)
+            if not waiters.futures and self._waiters.get(channel) is waiters:
+                del self._waiters[channel]
+                await self.unsubscribe(channel, waiters)
+
+    def dispatch(self, channel: str, data: str):
+        # Every local subscriber shares the frame, so each wire format is encoded once per event.
+        frame = Frame(data)
+        for handler in list(self._handlers.get(channel, ())):
+            try:
+                handler(frame)
+            except Exception:
+                log.exception("Handler error on %s", channel)
+
+
+class LocalHub(Hub):
+    """Hub for STATE_BACKEND=memory, where everything that is published is published by this process."""
+
+    async def subscribe(self, channel: str, handler):
+        self._handlers.setdefault(channel, {})[handler] = None
+
+    async def unsubscribe(self, channel: str, handler):
+        handlers = self._handlers.get(channel)
+        if handlers is not None:
+            handlers.pop(handler, None)
+            if not handlers:
+                del self._handlers[channel]
+
+    async def publish(self, *messages):
+        # Delivered on a later loop iteration and in order, like a message coming back from Redis.
+        loop = asyncio.get_running_loop()
+        for channel, message in messages:
+            loop.call_soon(self.dispatch, channel, message)
+
+    async def stop(self):
+        self._handlers.clear()
+        self._waiters.clear()
+
+    def stats(self):
+        return {"connections": 0, **super().stats()}
+
+
+class PubSubHub(Hub):
+    """One Redis pub/sub connection per worker, fanned out to the local subscribers of each channel.
+    In cluster mode there is one connection per node, each holding the shard channels of that node's slots."""
+
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+        self._pubsubs = {}
+        self._subscribed = {}
+        self._tasks = {}
+        self._nodes = {}
+        # Per channel: resolved once its SUBSCRIBE is done (with the error if it failed), and while its
+        # UNSUBSCRIBE is on the way. The lock only guards the tables; no round trip is made under it.
+        self._live = {}
+        self._leaving = {}
+        self._lock = asyncio.Lock()
+        self._stopping = False
+
+    async def _node_for(self, channel: str, refresh: bool = False):
+        if not settings.REDIS_CLUSTER:
+            return None
+        await self._client.initialize()
+        if refresh:
+            await self._client.nodes_manager.initialize()
+        return self._client.get_node_from_key(channel).name
+
+    def _ensure_started(self, node):
+        if node not in self._pubsubs:
+            if node is None:
+                self._pubsubs[node] = self._client.pubsub()
+            else:
+                cluster_node = self._client.get_node(node_name=node)
+                pool = redis.ConnectionPool(
+                    connection_class=cluster_node.connection_class, **cluster_node.connection_kwargs
+                )
+                self._pubsubs[node] = ShardedPubSub(pool)
+            self._subscribed[node] = asyncio.Event()
+        task = self._tasks.get(node)
+        if task is None or task.done():
+            self._stopping = False
+            self._tasks[node] = asyncio.create_task(self._run(node))
+
+    async def stop(self):
+        if self._tasks:
+            # Let the readers notice the flag between reads rather than cancelling them mid-response.
+            self._stopping = True
+            for event in self._subscribed.values():
+                event.set()
+            done, pending = await asyncio.wait(self._tasks.values(), timeout=2)
+            for task in pending:
+                task.cancel()
+            self._tasks.clear()
+        for node, pubsub in self._pubsubs.items():
+            await pubsub.aclose()
+            if node is not None:
+                await pubsub.connection_pool.disconnect()
+        self._pubsubs.clear()
+        self._subscribed.clear()
+        self._nodes.clear()
+        self._live.clear()
+        self._leaving.clear()
+        self._handlers.clear()
+        self._waiters.clear()
+
+    def stats(self):
+        return {"connections": len(self._pubsubs), **super().stats()}
+
+    async def publish(self, *messages):
+        """Publishes (channel, message) pairs in one round trip."""
+        async with self._client.pipeline(transaction=False) as pipe:
+            for channel, message in messages:
+                publish(pipe, channel, message)
+            await pipe.execute()
+
+    async def subscribe(self, channel: str, handler):
+        """Returns once the channel is live. The first subscriber sends the SUBSCRIBE and any others arriving
+        meanwhile wait for it, so connects on other channels never queue behind this round trip."""
+        async with self._lock:
+            handlers = self._handlers.get(channel)
+            first = handlers is None
+            if first:
+                handlers = self._handlers[channel] = {}
+                live = self._live[channel] = asyncio.get_running_loop().create_future()
+                leaving = self._leaving.get(channel)
+            else:
+                live = self._live[channel]
+            handlers[handler] = None
+        if not first:
+            error = await asyncio.shield(live)
+            if error is not None:
+                raise error
+            return
+        try:
+            if leaving is not None:
+                # The last subscriber's UNSUBSCRIBE goes out first, or it would undo this SUBSCRIBE.
+                await asyncio.shield(leaving)
+            await self._subscribe(channel, await self._node_for(channel))
+        except BaseException as e:
+            async with self._lock:
+                if self._live.get(channel) is live:
+                    del self._handlers[channel]
+                    del self._live[channel]
+            live.set_result(e)
+            raise
+        live.set_result(None)
+
+    async def _subscribe(self, channel: str, node):
+        self._ensure_started(node)
+        await self._pubsubs[node].subscribe(channel)
+        self._nodes[channel] = node
+        self._subscribed[node].set()
+
+    async def unsubscribe(self, channel: str, handler):
+        async with self._lock:
+            handlers = self._handlers.get(channel)
+            if handlers is None:
+                return
+            handlers.pop(handler, None)
+            if handlers:
+                return
+            del self._handlers[channel]
+            live = self._live.pop(channel)
+            leaving = self._leaving[channel] = asyncio.get_running_loop().create_future()
+        try:
+            # Only once the SUBSCRIBE is through, so the two reach the server in order.
+            if await asyncio.shield(live) is None:
+                pubsub = self._pubsubs.get(self._nodes.pop(channel, None))
+                if pubsub is not None:
+                    await pubsub.unsubscribe(channel)
+        finally:
+            leaving.set_result(None)
+            if self._leaving.get(channel) is leaving:
+                del self._leaving[channel]
+
+    async def _follow_slot(self, channel: str):
+        # The server drops shard channel subscribers when the slot migrates or fails over;
+        # look the owner up again and resubscribe there.
+        async with self._lock:
+            if channel not in self._handlers or self._stopping:
+                return
+            try:
+                await self._subscribe(channel, await self._node_for(channel, refresh=True))
+                log.info("Resubscribed %s after a slot move", channel)
+            except Exception:
+                self._nodes.pop(channel, None)
+                log.exception("Could not resubscribe %s", channel)
+
+    async def _run(self, node):
+        pubsub = self._pubsubs[node]
+        subscribed = self._subscribed[node]
+        while not self._stopping:
+            if not pubsub.subscribed:
+                subscribed.clear()
+                await subscribed.wait()
+                continue
+            try:
+                message = await pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Reader error: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            kind = message["type"]
+            channel = message["channel"].decode() if isinstance(message["channel"], bytes) else message["channel"]
+            if kind == "sunsubscribe" and message["channel"] in pubsub.channels:
+                # Not one we asked for: the slot has moved.
+                del pubsub.channels[message["channel"]]
+                if self._nodes.get(channel) == node:
+                    del self._nodes[channel]
+                    asyncio.create_task(self._follow_slot(channel))
+                continue
+            if kind != "message" and kind != "smessage":
+                continue
+            data = message["data"].decode("utf-8") if isinstance(message["data"], bytes) else message["data"]
+            sent_at = data.rfind(SENT_AT)
+            if sent_at != -1:
+                try:
+                    PUBSUB_LAG_SECONDS.observe(max(time.time() - float(data[sent_at + len(SENT_AT):-1]), 0))
+                except ValueError:
+                    pass
+            self.dispatch(channel, data)
+
+
+hub = LocalHub() if settings.STATE_BACKEND == "memory" else PubSubHub(redis_client)
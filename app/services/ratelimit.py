@@ -0,0 +1,137 @@
+import asyncio
+import math
+import time
+from fastapi import Depends, HTTPException, status
+from typing import Dict
+from app.redis import redis_client, run_scripts
+from app.core.cache import TTLCache
+from app.core.config import get_settings
+from app.core.keys import ratelimit_key
+from app.core.log import get_logger
+from app.core.metrics import RATE_LIMITED
+from app.services.auth import get_current_user
+
+settings = get_settings()
+log = get_logger("ratelimit")
+
+# Refills the bucket for the time since it was last settled and takes the tokens a worker has spent.
+# Workers admit locally and settle afterwards, so the bucket may go into debt (at most one burst),
+# which then holds back every worker until it has refilled.
+# KEYS: ratelimit:{<username>}:<action>
+# ARGV: tokens per second, burst, now, tokens spent
+# Returns the tokens left.
+SETTLE_TOKENS = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+if bucket[2] then
+    tokens = math.min(burst, tokens + math.max(now - tonumber(bucket[2]), 0) * rate)
+end
+tokens = math.max(tokens - tonumber(ARGV[4]), -burst)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', ARGV[3])
+-- Once it would have refilled completely the bucket is as good as new.
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+return tostring(tokens)
+"""
+
+
+class RateLimiter:
+    """Per-user, per-action token buckets. Each worker admits or refuses from its own copy of the bucket,
+    so a check costs no round trip. Once half a bucket's burst is spent the worker settles its spending
+    against the bucket in Redis (batched every RATE_LIMIT_SYNC_INTERVAL, see run_scripts) and takes back
+    the balance left by all workers. Traffic well under its limit and refused traffic never reach Redis;
+    a user spread over several workers can get up to a burst from each before they catch up.
+    Without a client (STATE_BACKEND=memory) the local buckets are the only ones and never settle."""
+
+    def __init__(self, client):
+        self._client = client
+        self._settle = client.register_script(SETTLE_TOKENS) if client is not None else None
+        self._buckets = TTLCache(settings.RATE_LIMIT_CACHE_SIZE, 60.0)
+        self._spent = {}
+        self._syncing = None
+
+    def allow(self, action: str, username: str):
+        limit = settings.RATE_LIMITS.get(action)
+        if limit is None:
+            return True
+        rate, burst = limit
+        key = (action, username)
+        now = time.time()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens, unsettled = burst, 0
+        else:
+            tokens, unsettled = min(burst, bucket[0] + (now - bucket[1]) * rate), bucket[2]
+        if tokens < 1:
+            RATE_LIMITED.labels(action).inc()
+            return False
+        tokens -= 1
+        unsettled += 1
+        if tokens < burst / 2 and self._client is not None:
+            self._spent[key] = self._spent.get(key, 0) + unsettled
+            unsettled = 0
+            if self._syncing is None:
+                self._syncing = asyncio.create_task(self._sync())
+        self._store(key, tokens, now, unsettled, rate, burst)
+        return True
+
+    def _store(self, key, tokens: float, now: float, unsettled: int, rate: float, burst: int):
+        # Forgotten once full again: a missing bucket is a full one.
+        self._buckets.set(key, (tokens, now, unsettled), ttl=(burst - tokens) / rate)
+
+    def available(self, action: str, username: str):
+        """Whether the action would be admitted now, without spending a token."""
+        limit = settings.RATE_LIMITS.get(action)
+        if limit is None:
+            return True
+        rate, burst = limit
+        bucket = self._buckets.get((action, username))
+        return bucket is None or min(burst, bucket[0] + (time.time() - bucket[1]) * rate) >= 1
+
+    def check(self, action: str, username: str, spend: bool = True):
+        """Raises 429 over the limit. With spend=False the bucket is only looked at; allow() charges it later."""
+        if not (self.allow(action, username) if spend else self.available(action, username)):
+            rate, _ = settings.RATE_LIMITS[action]
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, slow down",
+                headers={"Retry-After": str(math.ceil(1 / rate))},
+            )
+
+    async def _sync(self):
+        await asyncio.sleep(settings.RATE_LIMIT_SYNC_INTERVAL)
+        spent, self._spent = self._spent, {}
+        self._syncing = None
+        now = time.time()
+        try:
+            balances = await run_scripts([
+                (self._settle, [ratelimit_key(username, action)], [*settings.RATE_LIMITS[action], now, count])
+                for (action, username), count in spent.items()
+            ])
+        except Exception as e:
+            log.warning("Could not settle %d rate limit buckets: %s", len(spent), e)
+            return
+        now = time.time()
+        for key, balance in zip(spent, balances):
+            rate, burst = settings.RATE_LIMITS[key[0]]
+            # Redis has every worker's spending up to the sync; what this worker admitted since comes on top.
+            tokens = float(balance) - self._spent.get(key, 0)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._store(key, tokens, now, 0, rate, burst)
+            elif tokens < min(burst, bucket[0] + (now - bucket[1]) * rate):
+                self._store(key, tokens, now, bucket[2], rate, burst)
+
+    def stats(self):
+        return {"limits": settings.RATE_LIMITS, "buckets": len(self._buckets), "unsettled": len(self._spent)}
+
+
+rate_limiter = RateLimiter(None if settings.STATE_BACKEND == "memory" else redis_client)
+
+
+def rate_limited(action: str):
+    """Dependency for routes: the current user, once the action's limit lets the request through."""
+    async def dependency(current_user: Dict = Depends(get_current_user)):
+        rate_limiter.check(action, current_user["username"])
+        return current_user
+    return dependency
@@ -0,0 +1,136 @@
+import time
+from app.core.codec import Frame
+from app.core.config import get_settings
+from app.core.keys import room_channel
+from app.core.metrics import TRACKED_ROOMS
+from app.services.ownership import room_action
+from app.services.pubsub import hub
+from app.services.store import store
+
+settings = get_settings()
+
+ENDED_EVENTS = {"players_win", "spy_win", "spy_lose", "spy_win_timeout", "spy_win_two_players"}
+PASSIVE_EVENTS = {"new_submission", "vote_cast"}
+
+
+class RoomState:
+    __slots__ = ("status", "current_turn", "players", "users", "spy", "secret_location", "expires_at")
+
+    def __init__(self, status, current_turn, players, users, spy, secret_location):
+        self.status = status
+        self.current_turn = current_turn
+        self.players = players
+        self.users = users
+        self.spy = spy
+        self.secret_location = secret_location
+        self.expires_at = time.monotonic() + settings.ROOM_CACHE_TTL
+
+    @property
+    def current_player(self):
+        if 0 <= self.current_turn < len(self.users):
+            return self.users[self.current_turn]
+        return None
+
+
+@room_action
+async def room_state(room_id: str):
+    return await store.room_state(room_id)
+
+
+class RoomStateCache:
+    """Per-worker cache of the rooms that have local sockets, kept fresh by the rooms' own pub/sub events."""
+
+    def __init__(self):
+        self._rooms = {}
+        self._handlers = {}
+        self._refs = {}
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def track(self, room_id: str):
+        self._refs[room_id] = self._refs.get(room_id, 0) + 1
+        if self._refs[room_id] == 1:
+            handler = self._handlers[room_id] = lambda frame: self.apply_event(room_id, frame)
+            await hub.subscribe(room_channel(room_id), handler)
+
+    async def untrack(self, room_id: str):
+        refs = self._refs.get(room_id, 0) - 1
+        if refs > 0:
+            self._refs[room_id] = refs
+            return
+        self._refs.pop(room_id, None)
+        self._rooms.pop(room_id, None)
+        self._versions.pop(room_id, None)
+        handler = self._handlers.pop(room_id, None)
+        if handler:
+            await hub.unsubscribe(room_channel(room_id), handler)
+
+    async def get(self, room_id: str):
+        state = self._rooms.get(room_id)
+        if state is not None and state.expires_at > time.monotonic():
+            self.hits += 1
+            return state
+        self.misses += 1
+        version = self._versions.get(room_id, 0)
+        fields = await room_state(room_id)
+        if fields is None:
+            self._rooms.pop(room_id, None)
+            return None
+        state = RoomState(*fields)
+        # Only rooms with local sockets are cached, and only if no event raced with the read.
+        if room_id in self._refs and self._versions.get(room_id, 0) == version:
+            self._rooms[room_id] = state
+        return state
+
+    def invalidate(self, room_id: str):
+        if self._rooms.pop(room_id, None) is not None:
+            self.invalidations += 1
+        self._versions[room_id] = self._versions.get(room_id, 0) + 1
+
+    def apply_event(self, room_id: str, frame: Frame):
+        self._versions[room_id] = self._versions.get(room_id, 0) + 1
+        state = self._rooms.get(room_id)
+        if state is None:
+            return
+        event = frame.data
+        kind = event.get("type")
+        if kind in PASSIVE_EVENTS:
+            return
+        if kind == "turn" and event.get("current_player") in state.users:
+            state.status = "active"
+            state.current_turn = state.users.index(event["current_player"])
+        elif kind in ("start_voting", "voting_tie"):
+            state.status = "voting"
+        elif kind == "player_eliminated" and event.get("player") in state.users:
+            state.users.remove(event["player"])
+            state.current_turn = 0
+            state.status = "active" if len(state.users) > 2 else "ended"
+        elif kind == "player_left" and event.get("player") in state.users:
+            state.users.remove(event["player"])
+            if state.current_turn >= len(state.users) > 0:
+                state.current_turn = 0
+        elif kind in ENDED_EVENTS:
+            state.status = "ended"
+        else:
+            self.invalidate(room_id)
+
+    def count(self, status: str):
+        return sum(1 for state in self._rooms.values() if state.status == status)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "rooms": len(self._rooms),
+            "tracked_rooms": len(self._refs),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "invalidations": self.invalidations,
+        }
+
+
+room_cache = RoomStateCache()
+for status in ("active", "voting", "ended"):
+    TRACKED_ROOMS.labels(status).set_function(lambda status=status: room_cache.count(status))
@@ -0,0 +1,82 @@
+import time
+from app.redis import redis_client
+from app.core.config import get_settings
+from app.core.keys import (
+    pool_key, rooms_key, ROOM_DEADLINES_KEY, GAME_COUNTERS_KEY
+)
+
+settings = get_settings()
+
+# Secondary indexes kept next to the room state, so live statistics never scan rooms:
+#   rooms:{stats}:active / rooms:{stats}:voting   set of room ids per status
+#   rooms:{stats}:deadlines                       room id -> time its game_timeout fires
+#   {stats}:counters                              hash with the number of players in game
+# The room scripts run on their room's slot and cannot touch these, so they are updated next to them.
+# Cluster pipelines refuse EVALSHA and SMOVE, so move_room and unindex_room go straight to the client;
+# index_room and player_left may also be queued on a pipeline.
+INDEXED_STATUSES = ("active", "voting")
+
+# Drops a room from the indexes; the player count only once, however often a room is cleaned up.
+# KEYS: rooms:{stats}:active, rooms:{stats}:voting, rooms:{stats}:deadlines, {stats}:counters
+# ARGV: room_id, players still in the room
+UNINDEX_ROOM = """
+local removed = redis.call('SREM', KEYS[1], ARGV[1]) + redis.call('SREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+if removed > 0 then
+    redis.call('HINCRBY', KEYS[4], 'players', -tonumber(ARGV[2]))
+end
+return removed
+"""
+
+unindex_room_script = redis_client.register_script(UNINDEX_ROOM)
+
+
+def index_room(pipe, room_id: str, players: int, deadline: float):
+    pipe.sadd(rooms_key("active"), room_id)
+    pipe.zadd(ROOM_DEADLINES_KEY, {room_id: deadline})
+    pipe.hincrby(GAME_COUNTERS_KEY, "players", players)
+
+
+def move_room(client, room_id: str, previous: str, status: str):
+    return client.smove(rooms_key(previous), rooms_key(status), room_id)
+
+
+def player_left(client):
+    return client.hincrby(GAME_COUNTERS_KEY, "players", -1)
+
+
+def unindex_room(client, room_id: str, players: int):
+    return unindex_room_script(
+        keys=[rooms_key("active"), rooms_key("voting"), ROOM_DEADLINES_KEY, GAME_COUNTERS_KEY],
+        args=[room_id, players],
+        client=client,
+    )
+
+
+async def live_stats(ending_within: float, limit: int = 20):
+    """Pool, room and player counts from the indexes: a fixed number of commands in one round trip."""
+    now = time.time()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for shard in range(settings.MATCHMAKING_SHARDS):
+            pipe.zcard(pool_key(shard))
+        for status in INDEXED_STATUSES:
+            pipe.scard(rooms_key(status))
+        pipe.hget(GAME_COUNTERS_KEY, "players")
+        pipe.zcount(ROOM_DEADLINES_KEY, now, now + ending_within)
+        pipe.zrangebyscore(ROOM_DEADLINES_KEY, now, now + ending_within, start=0, num=limit, withscores=True)
+        results = await pipe.execute()
+    shards = results[:settings.MATCHMAKING_SHARDS]
+    statuses = results[settings.MATCHMAKING_SHARDS:-3]
+    players, ending, soonest = results[-3:]
+    return {
+        "pool": {"waiting": sum(shards), "shards": shards},
+        "rooms": dict(zip(INDEXED_STATUSES, statuses)),
+        "players_in_game": int(players or 0),
+        "ending_soon": {
+            "within_seconds": ending_within,
+            "rooms": ending,
+            "soonest": [
+                {"room_id": room_id.decode(), "seconds_left": round(deadline - now, 1)} for room_id, deadline in soonest
+            ],
+        },
+    }
@@ -0,0 +1,26 @@
+from app.core.codec import loads
+
+# A room's hash names its players once, comma-joined in `players`; everything else refers to them by their
+# 0-based index in that roster, so the hash stays small enough for Redis's compact listpack encoding:
+#   alive      packed indices (one byte each) of the players still in the game, in turn order
+#   ballot     one byte per roster position: 0 not voted yet, k voted for player k - 1, 255 for nobody
+#   spy        the spy's index
+# Question entries are [index, question, answer], and room:{<id>}:connected is a bitmap of the players with
+# a room socket open. The room scripts read and write the same layout.
+
+
+def split(players: bytes):
+    return players.decode().split(",")
+
+
+def names(players, packed: bytes):
+    return [players[index] for index in packed]
+
+
+def question_of(entry):
+    return loads(entry)[1] if entry else None
+
+
+def question_record(players, entry):
+    index, question, answer = loads(entry)
+    return {"player": players[index], "answer": answer, "question": question}
@@ -0,0 +1,243 @@
+from app.redis import redis_client
+
+# Pops the ARGV[3] longest-waiting players from a pool shard, skipping anyone who already holds a room,
+# and assigns them the room, all in one atomic step. Assignments are fields of the shard's bucket hashes,
+# which share the pool's {pool:<shard>} tag, so the script stays on one cluster slot; the caller writes the
+# room hash (another slot) afterwards. A bucket expires ttl after its last assignment, when every room
+# assigned in it has ended.
+# KEYS: waiting_pool:{pool:<shard>}
+# ARGV: room_id, min_size, max_size, ttl, assigned key prefix of the shard, buckets per shard
+CLAIM_PLAYERS = """
+-- Same as assignment_bucket() in app.core.keys; there is no crc32 here.
+local function bucket_of(user)
+    local hash = 0
+    for i = 1, #user do
+        hash = (hash * 31 + string.byte(user, i)) % 4294967296
+    end
+    return ARGV[5] .. (hash % tonumber(ARGV[6]))
+end
+
+local popped = redis.call('ZPOPMIN', KEYS[1], ARGV[3])
+local users, joined, buckets = {}, {}, {}
+for i = 1, #popped, 2 do
+    local bucket = bucket_of(popped[i])
+    if redis.call('HEXISTS', bucket, popped[i]) == 0 then
+        table.insert(users, popped[i])
+        table.insert(joined, popped[i + 1])
+        table.insert(buckets, bucket)
+    end
+end
+if #users < tonumber(ARGV[2]) then
+    -- Put them back with their original join times so nobody loses their place in line.
+    for i, user in ipairs(users) do
+        redis.call('ZADD', KEYS[1], joined[i], user)
+    end
+    return {}
+end
+for i, user in ipairs(users) do
+    redis.call('HSET', buckets[i], user, ARGV[1])
+    redis.call('EXPIRE', buckets[i], ARGV[4])
+end
+return {users, joined}
+"""
+
+# Helpers shared by the room state machine scripts below, for the room hash layout described in
+# app.services.roster; the scripts read the fields they need with one HMGET and decode them here.
+# Each room keeps its questions in a list (room:{<id>}:questions), given the room hash's remaining TTL.
+# tally() appends a record of the ballot it consumed for the game history:
+# {round, ballot number within the round, flat voter/voted_for pairs[, the round's questions and the roster once decided]}.
+ROOM_HELPERS = """
+local function roster(players)
+    local result = {}
+    for player in string.gmatch(players or '', '[^,]+') do
+        table.insert(result, player)
+    end
+    return result
+end
+
+local function indices(packed)
+    return {string.byte(packed or '', 1, -1)}
+end
+
+local function names(players, alive)
+    local result = {}
+    for i, index in ipairs(alive) do
+        result[i] = players[index + 1]
+    end
+    return table.concat(result, ',')
+end
+
+local function index_of(list, value)
+    for i, candidate in ipairs(list) do
+        if candidate == value then
+            return i
+        end
+    end
+    return nil
+end
+
+local function tally(room, questions_key, players_field, alive_field, ballot)
+    local players, alive = roster(players_field), indices(alive_field)
+    local counts, votes = {}, {}
+    for _, index in ipairs(alive) do
+        counts[index] = 0
+    end
+    for voter = 1, #ballot do
+        local voted = string.byte(ballot, voter)
+        if voted ~= 0 then
+            if counts[voted - 1] then
+                counts[voted - 1] = counts[voted - 1] + 1
+            end
+            table.insert(votes, players[voter])
+            table.insert(votes, players[voted] or '')
+        end
+    end
+    local max_votes, top = -1, {}
+    for _, index in ipairs(alive) do
+        if counts[index] > max_votes then
+            max_votes, top = counts[index], {index}
+        elseif counts[index] == max_votes then
+            table.insert(top, index)
+        end
+    end
+    local fields = redis.call('HMGET', room, 'round', 'ballots', 'spy')
+    local round, number, spy = tonumber(fields[1] or '1'), tonumber(fields[2] or '0') + 1, tonumber(fields[3])
+    redis.call('HDEL', room, 'ballot')
+    if #top ~= 1 then
+        redis.call('HSET', room, 'ballots', number)
+        return {'tie', {round, number, votes}}
+    end
+    local record = {round, number, votes, redis.call('LRANGE', questions_key, 0, -1), players_field}
+    redis.call('DEL', questions_key)
+    local voted = top[1]
+    if voted == spy then
+        redis.call('HSET', room, 'round', round + 1, 'ballots', 0, 'status', 'ended')
+        return {'players_win', players[spy + 1], record}
+    end
+    table.remove(alive, index_of(alive, voted))
+    redis.call('HSET', room,
+        'round', round + 1, 'ballots', 0,
+        'alive', string.char(unpack(alive)),
+        'current_turn', '0',
+        'status', #alive > 2 and 'active' or 'ended')
+    return {'eliminated', players[spy + 1], players[voted + 1], tostring(#alive), record}
+end
+"""
+
+# Records the current player's submission (or a timeout) and advances the turn.
+# KEYS: room:{<id>}, room:{<id>}:questions
+# ARGV: expected_turn ('' for any), player ('' for a timeout), question, answer
+# Returns nil when the action is stale, {'voting'} when the round is over,
+# otherwise {'turn', next_turn, comma-joined players still in, last_entry}.
+ADVANCE_TURN = ROOM_HELPERS + """
+local room = redis.call('HMGET', KEYS[1], 'status', 'current_turn', 'players', 'alive')
+if room[1] ~= 'active' then
+    return false
+end
+local turn = tonumber(room[2])
+if ARGV[1] ~= '' and turn ~= tonumber(ARGV[1]) then
+    return false
+end
+local players, alive = roster(room[3]), indices(room[4])
+local last_entry
+if ARGV[2] ~= '' then
+    if not alive[turn + 1] or players[alive[turn + 1] + 1] ~= ARGV[2] then
+        return false
+    end
+    last_entry = cjson.encode({alive[turn + 1], ARGV[3], ARGV[4]})
+    if redis.call('RPUSH', KEYS[2], last_entry) == 1 then
+        -- The room's TTL never changes, so the list only needs it once.
+        local ttl = redis.call('PTTL', KEYS[1])
+        if ttl > 0 then
+            redis.call('PEXPIRE', KEYS[2], ttl)
+        end
+    end
+end
+local next_turn = turn + 1
+if next_turn >= #alive then
+    redis.call('HSET', KEYS[1], 'current_turn', next_turn, 'status', 'voting')
+    return {'voting'}
+end
+redis.call('HSET', KEYS[1], 'current_turn', next_turn)
+return {'turn', tostring(next_turn), names(players, alive), last_entry or redis.call('LINDEX', KEYS[2], -1)}
+"""
+
+# Records a ballot and, once every player has voted, tallies it in the same step.
+# KEYS: room:{<id>}, room:{<id>}:questions
+# ARGV: voter, voted_for
+# Returns nil when the vote is rejected, {'cast'} or {'cast', <tally outcome...>}.
+CAST_VOTE = ROOM_HELPERS + """
+local room = redis.call('HMGET', KEYS[1], 'status', 'players', 'alive', 'ballot')
+if room[1] ~= 'voting' then
+    return false
+end
+local players, alive = roster(room[2]), indices(room[3])
+local voter = index_of(players, ARGV[1])
+if not voter or not index_of(alive, voter - 1) then
+    return false
+end
+local ballot = (room[4] or '') .. string.rep(string.char(0), #players - #(room[4] or ''))
+ballot = string.sub(ballot, 1, voter - 1) .. string.char(index_of(players, ARGV[2]) or 255) .. string.sub(ballot, voter + 1)
+for _, index in ipairs(alive) do
+    if string.byte(ballot, index + 1) == 0 then
+        redis.call('HSET', KEYS[1], 'ballot', ballot)
+        return {'cast'}
+    end
+end
+local outcome = tally(KEYS[1], KEYS[2], room[2], room[3], ballot)
+table.insert(outcome, 1, 'cast')
+return outcome
+"""
+
+# Tallies the current ballot if the room is still voting (used by the voting timeout).
+# KEYS: room:{<id>}, room:{<id>}:questions
+PROCESS_VOTES = ROOM_HELPERS + """
+local room = redis.call('HMGET', KEYS[1], 'status', 'players', 'alive', 'ballot')
+if room[1] ~= 'voting' then
+    return false
+end
+return tally(KEYS[1], KEYS[2], room[2], room[3], room[4] or '')
+"""
+
+# Ends the game if it is in one of the given statuses and returns the spy.
+# KEYS: room:{<id>}
+# ARGV: allowed statuses
+END_GAME = ROOM_HELPERS + """
+local room = redis.call('HMGET', KEYS[1], 'status', 'players', 'spy')
+for _, allowed in ipairs(ARGV) do
+    if room[1] == allowed then
+        redis.call('HSET', KEYS[1], 'status', 'ended')
+        return roster(room[2])[tonumber(room[3]) + 1]
+    end
+end
+return false
+"""
+
+# Removes a player from the game, keeping current_turn in range.
+# KEYS: room:{<id>}
+# ARGV: player
+# Returns the number of remaining players, or nil if the player was not in the room.
+LEAVE_ROOM = ROOM_HELPERS + """
+local room = redis.call('HMGET', KEYS[1], 'players', 'alive', 'current_turn')
+local alive = indices(room[2])
+local index = index_of(alive, (index_of(roster(room[1]), ARGV[1]) or 0) - 1)
+if not index then
+    return false
+end
+table.remove(alive, index)
+if #alive > 0 then
+    local current_turn = tonumber(room[3])
+    if current_turn >= #alive then
+        current_turn = 0
+    end
+    redis.call('HSET', KEYS[1], 'alive', string.char(unpack(alive)), 'current_turn', current_turn)
+end
+return #alive
+"""
+
+claim_players_script = redis_client.register_script(CLAIM_PLAYERS)
+advance_turn_script = redis_client.register_script(ADVANCE_TURN)
+cast_vote_script = redis_client.register_script(CAST_VOTE)
+process_votes_script = redis_client.register_script(PROCESS_VOTES)
+end_game_script = redis_client.register_script(END_GAME)
+leave_room_script = redis_client.register_script(LEAVE_ROOM)
@@ -0,0 +1,379 @@
+import abc
+import math
+import time
+from app.redis import redis_client
+from app.core.config import get_settings
+from app.core.keys import (
+    shard_of, room_key, connected_key, questions_key, pool_key, assigned_prefix, assigned_key, matched_key,
+    wakeup_channel
+)
+from app.services.events import publish_room_event, room_events_since
+from app.services.pubsub import publish
+from app.services.room_index import index_room, move_room, player_left, unindex_room, live_stats
+from app.services.roster import split, names, question_of, question_record
+from app.services.scripts import (
+    claim_players_script, advance_turn_script, cast_vote_script, process_votes_script, end_game_script,
+    leave_room_script
+)
+
+settings = get_settings()
+
+# Placements are counted in buckets of this many seconds to estimate queue throughput.
+MATCH_RATE_BUCKET = 10
+# Room keys and assignment buckets outlive the game timer by its claim lease, so that the timer (which may
+# fire up to a lease late) rather than the expiry ends the game and cleans up after it.
+ROOM_TTL = settings.GAME_TIMEOUT + math.ceil(settings.TIMER_CLAIM_LEASE)
+
+
+def rate_buckets(now: float):
+    bucket = int(now // MATCH_RATE_BUCKET)
+    return range(bucket - settings.MATCHMAKING_RATE_WINDOW // MATCH_RATE_BUCKET + 1, bucket + 1)
+
+
+class GameStore(abc.ABC):
+    """Room state, the matchmaking pool and player assignments. The game logic only goes through this
+    interface, so it runs the same on Redis (shared by every worker), in the memory of each room's owner,
+    or all in process memory (STATE_BACKEND).
+    Each method is one atomic step. Turn and vote results:
+        advance_turn   None if stale, ("voting",) or ("turn", next_turn, players still in, previous question)
+        cast_vote      None if rejected, ("cast",) or ("cast", *tally outcome)
+        tally outcome  ("tie", record), ("players_win", spy, record)
+                       or ("eliminated", spy, voted, remaining, record)
+        record         (round, ballot number, [(voter, voted_for or None)], questions once the round is decided)
+    """
+
+    @abc.abstractmethod
+    async def join_pool(self, username: str):
+        """Queues the player (keeping an earlier join time) and wakes their shard's matchmaker."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def leave_pool(self, username: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def pool_size(self, shard: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def queue_position(self, username: str):
+        """(rank or None, joined_at or None, queued, players placed in the shard over MATCHMAKING_RATE_WINDOW)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def claim_players(self, shard: int, room_id: str, size: int):
+        """Pops up to size players who hold no room and assigns them room_id: (players, join times),
+        or None with everyone put back if that is under MIN_ROOM_SIZE."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def create_room(self, room_id: str, shard: int, players, spy: int, secret_location: str, now: float):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def assigned_room(self, username: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def clear_assignment(self, username: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def room_exists(self, room_id: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def room_state(self, room_id: str):
+        """(status, current_turn, roster, players still in, spy, secret_location), or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def connect(self, room_id: str, index: int):
+        """Marks the room socket of the player at this roster index as connected; returns how many are."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def disconnect(self, room_id: str, index: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def start_game(self, room_id: str):
+        """True for exactly one caller per room."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def turn_state(self, room_id: str):
+        """(status, players still in, previous question), or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def previous_question(self, room_id: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def advance_turn(self, room_id: str, expected_turn, player: str, question: str, answer: str):
+        """Records the current player's submission (player set) or a timeout (expected_turn set)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def cast_vote(self, room_id: str, voter: str, voted_for: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def process_votes(self, room_id: str):
+        """Tallies the ballot if the room is still voting."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def end_game(self, room_id: str, *statuses: str):
+        """Ends the game if it is in one of statuses; returns the spy, or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def leave_room(self, room_id: str, player: str):
+        """Takes the player out of the game; returns how many are left, or None if they were not in it."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def move_room(self, room_id: str, previous: str, status: str):
+        """Moves the room between the status indexes behind live_stats."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def player_left(self, room_id: str, reopened: bool = False):
+        """Counts a player out of the game, and the room back to active if a new round starts."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def close_room(self, room_id: str):
+        """Deletes the room and its players' assignments. Returns what the game history needs:
+        {players, alive, spy, secret_location, started_at, round, questions}, or None if it was gone."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def append_event(self, room_id: str, event: dict):
+        """Appends the event to the room's catch-up log and publishes it; returns its event_id."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def events_since(self, room_id: str, last_event_id: str):
+        """Frames for every event after last_event_id, or None if the log no longer reaches back to it."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def live_stats(self, ending_within: float, limit: int = 20):
+        raise NotImplementedError
+
+
+def _tally_outcome(outcome):
+    kind = outcome[0].decode()
+    record = outcome[-1]
+    votes = [
+        (voter.decode(), voted_for.decode() or None) for voter, voted_for in zip(record[2][::2], record[2][1::2])
+    ]
+    questions = None
+    if len(record) > 3:
+        players = split(record[4])
+        questions = [question_record(players, entry) for entry in record[3]]
+    record = (int(record[0]), int(record[1]), votes, questions)
+    if kind == "tie":
+        return kind, record
+    if kind == "players_win":
+        return kind, outcome[1].decode(), record
+    return kind, outcome[1].decode(), outcome[2].decode(), int(outcome[3]), record
+
+
+class RedisGameStore(GameStore):
+    """The state in Redis, laid out as described in app.core.keys and app.services.roster.
+    Anything that must be atomic is a Lua script on one slot (app.services.scripts)."""
+
+    def __init__(self, client):
+        self._client = client
+
+    async def join_pool(self, username: str):
+        shard = shard_of(username)
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zadd(pool_key(shard), {username: time.time()}, nx=True)
+            publish(pipe, wakeup_channel(shard), "")
+            await pipe.execute()
+
+    async def leave_pool(self, username: str):
+        return bool(await self._client.zrem(pool_key(shard_of(username)), username))
+
+    async def pool_size(self, shard: int):
+        return await self._client.zcard(pool_key(shard))
+
+    async def queue_position(self, username: str):
+        shard = shard_of(username)
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.zrank(pool_key(shard), username)
+            pipe.zscore(pool_key(shard), username)
+            pipe.zcard(pool_key(shard))
+            rank, joined_at, queued = await pipe.execute()
+        # Cluster pipelines refuse MGET; the buckets share the pool shard's tag, so this is still one slot.
+        matched = await self._client.mget([matched_key(shard, bucket) for bucket in rate_buckets(time.time())])
+        return rank, joined_at, queued, sum(int(count) for count in matched if count)
+
+    async def claim_players(self, shard: int, room_id: str, size: int):
+        result = await claim_players_script(
+            keys=[pool_key(shard)],
+            args=[
+                room_id, settings.MIN_ROOM_SIZE, size, ROOM_TTL, assigned_prefix(shard),
+                settings.ASSIGNMENT_BUCKETS,
+            ]
+        )
+        if not result:
+            return None
+        players, joined_at = result
+        return [player.decode() for player in players], [float(ts) for ts in joined_at]
+
+    async def create_room(self, room_id: str, shard: int, players, spy: int, secret_location: str, now: float):
+        rate_key = matched_key(shard, int(now // MATCH_RATE_BUCKET))
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.hset(room_key(room_id), mapping={
+                "secret_location": secret_location,
+                "spy": spy,
+                "players": ",".join(players),
+                "alive": bytes(range(len(players))),
+                "status": "active",
+                "current_turn": "0",
+                "start_time": int(now * 1000),
+            })
+            pipe.expire(room_key(room_id), ROOM_TTL)
+            index_room(pipe, room_id, len(players), now + settings.GAME_TIMEOUT)
+            pipe.incrby(rate_key, len(players))
+            pipe.expire(rate_key, settings.MATCHMAKING_RATE_WINDOW + MATCH_RATE_BUCKET)
+            await pipe.execute()
+
+    async def assigned_room(self, username: str):
+        room_id = await self._client.hget(assigned_key(username), username)
+        return room_id.decode() if room_id else None
+
+    async def clear_assignment(self, username: str):
+        await self._client.hdel(assigned_key(username), username)
+
+    async def room_exists(self, room_id: str):
+        return bool(await self._client.exists(room_key(room_id)))
+
+    async def room_state(self, room_id: str):
+        status, current_turn, players, alive, spy, secret_location = await self._client.hmget(
+            room_key(room_id), "status", "current_turn", "players", "alive", "spy", "secret_location"
+        )
+        if status is None:
+            return None
+        players = split(players)
+        return (
+            status.decode(), int(current_turn), players, names(players, alive), players[int(spy)],
+            secret_location.decode(),
+        )
+
+    async def connect(self, room_id: str, index: int):
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.setbit(connected_key(room_id), index, 1)
+            pipe.expire(connected_key(room_id), ROOM_TTL)
+            pipe.bitcount(connected_key(room_id))
+            _, _, connected = await pipe.execute()
+        return connected
+
+    async def disconnect(self, room_id: str, index: int):
+        await self._client.setbit(connected_key(room_id), index, 0)
+
+    async def start_game(self, room_id: str):
+        return bool(await self._client.hsetnx(room_key(room_id), "game_started", "1"))
+
+    async def turn_state(self, room_id: str):
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.hmget(room_key(room_id), "status", "players", "alive")
+            pipe.lindex(questions_key(room_id), -1)
+            (status, players, alive), last_entry = await pipe.execute()
+        if status is None:
+            return None
+        return status.decode(), names(split(players), alive), question_of(last_entry)
+
+    async def previous_question(self, room_id: str):
+        return question_of(await self._client.lindex(questions_key(room_id), -1))
+
+    async def advance_turn(self, room_id: str, expected_turn, player: str, question: str, answer: str):
+        result = await advance_turn_script(
+            keys=[room_key(room_id), questions_key(room_id)],
+            args=["" if expected_turn is None else expected_turn, player or "", question or "", answer or ""]
+        )
+        if not result:
+            return None
+        if result[0] == b"voting":
+            return ("voting",)
+        _, next_turn, players, last_entry = result
+        return "turn", int(next_turn), players.decode().split(","), question_of(last_entry)
+
+    async def cast_vote(self, room_id: str, voter: str, voted_for: str):
+        result = await cast_vote_script(keys=[room_key(room_id), questions_key(room_id)], args=[voter, voted_for])
+        if not result:
+            return None
+        if len(result) == 1:
+            return ("cast",)
+        return ("cast", *_tally_outcome(result[1:]))
+
+    async def process_votes(self, room_id: str):
+        result = await process_votes_script(keys=[room_key(room_id), questions_key(room_id)])
+        return _tally_outcome(result) if result else None
+
+    async def end_game(self, room_id: str, *statuses: str):
+        spy = await end_game_script(keys=[room_key(room_id)], args=list(statuses))
+        return spy.decode() if spy else None
+
+    async def leave_room(self, room_id: str, player: str):
+        return await leave_room_script(keys=[room_key(room_id)], args=[player])
+
+    async def move_room(self, room_id: str, previous: str, status: str):
+        await move_room(self._client, room_id, previous, status)
+
+    async def player_left(self, room_id: str, reopened: bool = False):
+        await player_left(self._client)
+        if reopened:
+            await move_room(self._client, room_id, "voting", "active")
+
+    async def close_room(self, room_id: str):
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(room_key(room_id))
+            pipe.lrange(questions_key(room_id), 0, -1)
+            room_data, questions = await pipe.execute()
+        if not room_data:
+            return None
+        players = split(room_data[b"players"])
+        alive = names(players, room_data.get(b"alive", b""))
+        async with self._client.pipeline(transaction=False) as pipe:
+            pipe.delete(room_key(room_id), connected_key(room_id), questions_key(room_id))
+            # Assignments live in their pool shard's slot, not the room's. Eliminated players hold theirs
+            # until the game ends too.
+            for player in players:
+                pipe.hdel(assigned_key(player), player)
+            await pipe.execute()
+        await unindex_room(self._client, room_id, len(alive))
+        return {
+            "players": players,
+            "alive": alive,
+            "spy": players[int(room_data[b"spy"])],
+            "secret_location": room_data[b"secret_location"].decode(),
+            "started_at": int(room_data[b"start_time"]) / 1000,
+            "round": int(room_data.get(b"round", 1)),
+            "questions": [question_record(players, entry) for entry in questions],
+        }
+
+    async def append_event(self, room_id: str, event: dict):
+        return await publish_room_event(room_id, event)
+
+    async def events_since(self, room_id: str, last_event_id: str):
+        return await room_events_since(room_id, last_event_id)
+
+    async def live_stats(self, ending_within: float, limit: int = 20):
+        return await live_stats(ending_within, limit)
+
+
+if settings.STATE_BACKEND == "memory":
+    from app.services.memory_store import MemoryGameStore
+    store = MemoryGameStore()
+elif settings.STATE_BACKEND == "owned":
+    from app.services.owned_store import OwnedGameStore
+    store = OwnedGameStore(redis_client)
+else:
+    store = RedisGameStore(redis_client)
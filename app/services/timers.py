@@ -0,0 +1,200 @@
+import asyncio
+import json
+import time
+from app.redis import redis_client
+from app.core.config import get_settings
+from app.core.keys import TIMERS_KEY, TIMER_ARGS_KEY
+from app.core.log import get_logger, log_context
+from app.core.metrics import TIMER_LATENESS_SECONDS
+
+settings = get_settings()
+log = get_logger("timers")
+
+# Moves every due timer to a lease score so exactly one worker fires it.
+# If that worker dies before acknowledging, the timer becomes due again once the lease runs out.
+# KEYS: timers, timer_args
+# ARGV: now, lease_until, limit
+# Returns member, args, due time triples.
+CLAIM_TIMERS = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[3])
+local claimed = {}
+for i = 1, #due, 2 do
+    local member = due[i]
+    redis.call('ZADD', KEYS[1], ARGV[2], member)
+    table.insert(claimed, member)
+    table.insert(claimed, redis.call('HGET', KEYS[2], member) or '{}')
+    table.insert(claimed, due[i + 1])
+end
+return claimed
+"""
+
+# Schedules (or reschedules) one timer. A script rather than a MULTI because cluster pipelines
+# cannot be transactions; both keys share the {timers} tag.
+# KEYS: timers, timer_args
+# ARGV: member, due, args
+SCHEDULE_TIMER = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+"""
+
+# KEYS: timers, timer_args
+# ARGV: members
+CANCEL_TIMERS = """
+redis.call('ZREM', KEYS[1], unpack(ARGV))
+redis.call('HDEL', KEYS[2], unpack(ARGV))
+"""
+
+# Removes a fired timer unless it was rescheduled while its handler ran.
+# KEYS: timers, timer_args
+# ARGV: member, lease_until
+ACK_TIMER = """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if score and tonumber(score) == tonumber(ARGV[2]) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+class TimerScheduler:
+    """Per-room timers, one per kind and room: scheduling again replaces the superseded one.
+    Subclasses decide where the timers are kept."""
+
+    def __init__(self):
+        self._handlers = {}
+        self._stopping = asyncio.Event()
+
+    def register(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    async def _call(self, member: str, args: dict, due: float):
+        kind, room_id = member.split(":", 1)
+        TIMER_LATENESS_SECONDS.labels(kind).observe(max(time.time() - due, 0))
+        handler = self._handlers.get(kind)
+        try:
+            with log_context(room_id=room_id, timer=kind):
+                if handler is None:
+                    log.warning("No handler registered for timer %s", member)
+                else:
+                    await handler(room_id, **args)
+        except Exception:
+            log.exception("Timer %s failed", member)
+
+    def stop(self):
+        self._stopping.set()
+
+
+class LocalTimerScheduler(TimerScheduler):
+    """Timers as event loop callbacks, in the process that holds their rooms (STATE_BACKEND=memory or owned).
+    changed, if set, is called with the room id whenever a room's timers change."""
+
+    def __init__(self):
+        super().__init__()
+        self._timers = {}
+        self._firing = set()
+        self.changed = None
+
+    async def schedule(self, kind: str, room_id: str, delay: float, **args):
+        member = f"{kind}:{room_id}"
+        timer = self._timers.pop(member, None)
+        if timer is not None:
+            timer[0].cancel()
+        loop = asyncio.get_running_loop()
+        due = time.time() + delay
+        self._timers[member] = (loop.call_later(delay, self._fire, member, args, due), due, args)
+        if self.changed is not None:
+            self.changed(room_id)
+
+    async def cancel(self, room_id: str, *kinds: str):
+        for kind in kinds or self._handlers:
+            timer = self._timers.pop(f"{kind}:{room_id}", None)
+            if timer is not None:
+                timer[0].cancel()
+        if self.changed is not None:
+            self.changed(room_id)
+
+    def pending(self, room_id: str):
+        """The room's timers as [kind, due time, args]."""
+        pending = []
+        for kind in self._handlers:
+            timer = self._timers.get(f"{kind}:{room_id}")
+            if timer is not None:
+                pending.append([kind, timer[1], timer[2]])
+        return pending
+
+    def _fire(self, member: str, args: dict, due: float):
+        del self._timers[member]
+        if self.changed is not None:
+            self.changed(member.split(":", 1)[1])
+        task = asyncio.create_task(self._call(member, args, due))
+        self._firing.add(task)
+        task.add_done_callback(self._firing.discard)
+
+    async def run(self):
+        self._stopping.clear()
+        await self._stopping.wait()
+        # Stopped but kept, so the rooms' last snapshots still carry them.
+        for timer in self._timers.values():
+            timer[0].cancel()
+
+
+class RedisTimerScheduler(TimerScheduler):
+    """Durable per-room timers kept in a Redis sorted set and fired by whichever worker claims them."""
+
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+        self._schedule = client.register_script(SCHEDULE_TIMER)
+        self._cancel = client.register_script(CANCEL_TIMERS)
+        self._claim = client.register_script(CLAIM_TIMERS)
+        self._ack = client.register_script(ACK_TIMER)
+
+    async def schedule(self, kind: str, room_id: str, delay: float, **args):
+        member = f"{kind}:{room_id}"
+        await self._schedule(keys=[TIMERS_KEY, TIMER_ARGS_KEY], args=[member, time.time() + delay, json.dumps(args)])
+
+    async def cancel(self, room_id: str, *kinds: str):
+        members = [f"{kind}:{room_id}" for kind in (kinds or self._handlers)]
+        if not members:
+            return
+        await self._cancel(keys=[TIMERS_KEY, TIMER_ARGS_KEY], args=members)
+
+    async def poll(self):
+        lease_until = time.time() + settings.TIMER_CLAIM_LEASE
+        claimed = await self._claim(
+            keys=[TIMERS_KEY, TIMER_ARGS_KEY],
+            args=[time.time(), lease_until, settings.TIMER_BATCH_SIZE]
+        )
+        fired = [
+            self._fire(member.decode(), json.loads(args), float(due), lease_until)
+            for member, args, due in zip(claimed[::3], claimed[1::3], claimed[2::3])
+        ]
+        await asyncio.gather(*fired)
+        return len(fired)
+
+    async def _fire(self, member: str, args: dict, due: float, lease_until: float):
+        try:
+            await self._call(member, args, due)
+        finally:
+            await self._ack(keys=[TIMERS_KEY, TIMER_ARGS_KEY], args=[member, lease_until])
+
+    async def run(self):
+        self._stopping.clear()
+        while not self._stopping.is_set():
+            try:
+                fired = await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Timer poll failed")
+                fired = 0
+            if fired < settings.TIMER_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=settings.TIMER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+
+timers = LocalTimerScheduler() if settings.STATE_BACKEND != "redis" else RedisTimerScheduler(redis_client)
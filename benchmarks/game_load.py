@@ -0,0 +1,306 @@
+"""End-to-end load test: simulated players register, queue, play a full game and report latencies.
+
+    python -m benchmarks.game_load --clients 1000
+    python -m benchmarks.game_load --redis-url redis://localhost:6379/15 --database-url postgresql+asyncpg://...
+    python -m benchmarks.game_load --backend memory
+
+Without --redis-url the app runs against fakeredis; without --database-url against a temporary SQLite file.
+With --backend memory the game state stays in the process (STATE_BACKEND=memory) and Redis is not used at all;
+with --backend owned the rooms stay in the process that owns them, with snapshots and everything else in Redis.
+Results are compared with benchmarks/baselines.json and the run fails on a regression beyond --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+BASELINES = Path(__file__).with_name("baselines.json")
+# Metrics where a larger value is an improvement; every other metric regresses when it grows.
+HIGHER_IS_BETTER = {"messages_per_sec"}
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def configure(args):
+    # Settings are read once at import, so the environment has to be in place before the app is loaded.
+    if args.database_url is None:
+        args.database_url = "sqlite+aiosqlite:///" + os.path.join(tempfile.mkdtemp(prefix="game-load-"), "bench.db")
+    os.environ["DATABASE_URL"] = args.database_url
+    if args.database_url.startswith("sqlite"):
+        # SQLite has a single writer; concurrent registrations would fail with "database is locked".
+        os.environ.setdefault("DB_POOL_SIZE", "1")
+        os.environ.setdefault("DB_MAX_OVERFLOW", "0")
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    if not args.verbose:
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("PASSWORD_HASH_MAX_PENDING", str(args.clients))
+    os.environ["STATE_BACKEND"] = args.backend
+    if args.redis_url is None:
+        # fakeredis does not answer the health-check PING the real pool sends before reusing a connection.
+        os.environ["REDIS_HEALTH_CHECK_INTERVAL"] = "0"
+    else:
+        os.environ["REDIS_URL"] = args.redis_url
+
+    import app.redis as app_redis
+    if args.redis_url is None:
+        import fakeredis
+        client = fakeredis.FakeAsyncRedis(
+            server=fakeredis.FakeServer(),
+            connection_pool_class=app_redis.MonitoredConnectionPool,
+            max_connections=app_redis.settings.REDIS_MAX_CONNECTIONS,
+        )
+        app_redis.redis_client = client
+        app_redis.redis_pool = client.connection_pool
+    return app_redis.redis_client
+
+
+class CommandCounter:
+    """Counts Redis commands and round trips; a pipeline is one round trip for all of its commands."""
+
+    def __init__(self, client):
+        from redis.asyncio.client import Pipeline
+
+        self.commands = 0
+        self.round_trips = 0
+        execute_command = client.execute_command
+        pipeline_execute = Pipeline.execute
+        counter = self
+
+        async def counted_command(*args, **options):
+            counter.commands += 1
+            counter.round_trips += 1
+            return await execute_command(*args, **options)
+
+        async def counted_pipeline(self, raise_on_error=True):
+            if self.command_stack:
+                counter.commands += len(self.command_stack)
+                counter.round_trips += 1
+            return await pipeline_execute(self, raise_on_error)
+
+        client.execute_command = counted_command
+        Pipeline.execute = counted_pipeline
+
+
+class LoadTest:
+    def __init__(self, clients, ramp_up, min_room_size):
+        self.clients = clients
+        self.ramp_up = ramp_up
+        self.min_room_size = min_room_size
+        self.matchmaking = []
+        self.round_trips = []
+        self.messages = 0
+        self.games = set()
+        self.spies = {}
+        self.members = {}
+        self.finished = 0
+        self.waiting = 0
+        self.unmatched = 0
+        self.failed = 0
+        self.stop = asyncio.Event()
+
+    def _check_stragglers(self):
+        # Everyone left is queued and too few remain to fill a room: nobody else is coming.
+        if self.waiting == self.clients - self.finished and self.waiting < self.min_room_size:
+            self.stop.set()
+
+    def _finish(self):
+        self.finished += 1
+        self._check_stragglers()
+
+    async def _receive(self, ws):
+        message = json.loads(await ws.receive_text())
+        self.messages += 1
+        return message
+
+    async def _register(self, client, username):
+        while True:
+            response = await client.post(
+                "/auth/register",
+                json={"username": username, "email": f"{username}@example.com", "password": "benchmark"}
+            )
+            if response.status_code != 429:
+                response.raise_for_status()
+                return response.json()["access_token"]
+            await asyncio.sleep(random.uniform(0.05, 0.2))
+
+    async def player(self, client, index):
+        username = f"bench{index}"
+        await asyncio.sleep(self.ramp_up * index / self.clients)
+        try:
+            token = await self._register(client, username)
+            room_id = await self._queue(client, username, token)
+            if room_id is not None:
+                await self._play(client, username, token, room_id)
+        except Exception as e:
+            self.failed += 1
+            print(f"{username} failed: {e!r}", file=sys.stderr)
+        finally:
+            self._finish()
+
+    async def _queue(self, client, username, token):
+        async with client.websocket_connect(f"/game/ws-user/{username}?token={token}") as user_ws:
+            started = time.perf_counter()
+            self.waiting += 1
+            try:
+                await client.post("/game/join-pool", headers={"Authorization": f"Bearer {token}"})
+                self._check_stragglers()
+                receive = asyncio.ensure_future(self._receive(user_ws))
+                stop = asyncio.ensure_future(self.stop.wait())
+                await asyncio.wait([receive, stop], return_when=asyncio.FIRST_COMPLETED)
+                stop.cancel()
+                if not receive.done():
+                    receive.cancel()
+                    self.unmatched += 1
+                    return None
+                message = receive.result()
+            finally:
+                self.waiting -= 1
+            self.matchmaking.append(time.perf_counter() - started)
+            return message["room_id"]
+
+    async def _play(self, client, username, token, room_id):
+        self.games.add(room_id)
+        self.members.setdefault(room_id, []).append(username)
+        async with client.websocket_connect(f"/game/ws/{room_id}?token={token}") as ws:
+            pending = None
+            while True:
+                message = await self._receive(ws)
+                kind = message["type"]
+                if kind == "role":
+                    if message["role"] == "spy":
+                        self.spies[room_id] = username
+                elif kind == "turn":
+                    if message["current_player"] == username and pending is None:
+                        pending = time.perf_counter()
+                        await ws.send_json({"submit_turn": True, "question": "Where are we?", "answer": "Somewhere"})
+                    elif message["current_player"] != username:
+                        pending = None
+                elif kind in ("start_voting", "voting_tie"):
+                    # Everyone votes for the spy, the spy for someone else, so the ballot closes at once.
+                    suspect = self.spies.get(room_id)
+                    if suspect == username:
+                        suspect = random.choice([member for member in self.members[room_id] if member != username])
+                    pending = time.perf_counter()
+                    await ws.send_json({"vote": suspect})
+                elif kind in ("new_submission", "vote_cast") and message["player"] == username:
+                    if pending is not None:
+                        self.round_trips.append(time.perf_counter() - pending)
+                    pending = None
+                elif kind == "room_closed":
+                    return
+
+    async def run(self, client):
+        started = time.perf_counter()
+        await asyncio.gather(*(self.player(client, i) for i in range(self.clients)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed, counter):
+        games = len(self.games)
+        ms = lambda value: round(value * 1000, 2) if value is not None else None
+        return {
+            "clients": self.clients,
+            "games": games,
+            "unmatched": self.unmatched,
+            "failed": self.failed,
+            "elapsed_sec": round(elapsed, 2),
+            "matchmaking_p50_ms": ms(percentile(self.matchmaking, 0.5)),
+            "matchmaking_p90_ms": ms(percentile(self.matchmaking, 0.9)),
+            "matchmaking_p99_ms": ms(percentile(self.matchmaking, 0.99)),
+            "round_trip_p50_ms": ms(percentile(self.round_trips, 0.5)),
+            "round_trip_p90_ms": ms(percentile(self.round_trips, 0.9)),
+            "round_trip_p99_ms": ms(percentile(self.round_trips, 0.99)),
+            "messages_per_sec": round(self.messages / elapsed, 1) if elapsed else None,
+            "redis_commands_per_game": round(counter.commands / games, 1) if games else None,
+            "redis_round_trips_per_game": round(counter.round_trips / games, 1) if games else None,
+        }
+
+
+# p99s are reported but too noisy between runs to gate on.
+COMPARED = [
+    "matchmaking_p50_ms", "matchmaking_p90_ms",
+    "round_trip_p50_ms", "round_trip_p90_ms",
+    "messages_per_sec", "redis_commands_per_game", "redis_round_trips_per_game",
+]
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for metric in COMPARED:
+        current, previous = result.get(metric), baseline.get(metric)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if metric in HIGHER_IS_BETTER:
+            change = -change
+        if change > tolerance:
+            regressions.append(f"{metric}: {previous} -> {current} ({change:+.0%})")
+    return regressions
+
+
+async def main(args):
+    redis_client = configure(args)
+    counter = CommandCounter(redis_client)
+    from async_asgi_testclient import TestClient
+    from app.main import app
+    from app.core.config import get_settings
+
+    load = LoadTest(args.clients, args.ramp_up, get_settings().MIN_ROOM_SIZE)
+    # The app logs every turn; keep it out of the report unless asked for.
+    with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+        async with TestClient(app, timeout=args.timeout) as client:
+            elapsed = await asyncio.wait_for(load.run(client), args.timeout)
+    return load.report(elapsed, counter)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--ramp-up", type=float, default=20.0, help="seconds over which clients arrive")
+    parser.add_argument("--redis-url", help="real Redis to use instead of fakeredis (its data is not cleared)")
+    parser.add_argument("--backend", choices=["redis", "memory", "owned"], default="redis", help="STATE_BACKEND to run")
+    parser.add_argument("--database-url", help="database to use instead of a temporary SQLite file")
+    parser.add_argument("--scenario", help="baseline name; defaults to <redis>-<database>-<clients>")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression per metric")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--no-compare", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output")
+    args = parser.parse_args()
+    redis = "redis" if args.redis_url else "fakeredis"
+    scenario = args.scenario or "-".join([
+        {"redis": redis, "memory": "memory", "owned": f"owned-{redis}"}[args.backend],
+        args.database_url.split("+")[0].split(":")[0] if args.database_url else "sqlite",
+        str(args.clients),
+    ])
+
+    result = asyncio.run(main(args))
+    print(json.dumps({scenario: result}, indent=2))
+
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    if args.save_baseline:
+        baselines[scenario] = result
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline {scenario}", file=sys.stderr)
+    elif not args.no_compare and scenario in baselines:
+        regressions = compare(result, baselines[scenario], args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    if result["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,157 @@
+"""Redis memory per room: creates rooms through the game code, brings each to its fullest point
+(every player connected, a round of questions asked, all but one vote cast) and measures what they hold.
+
+    python -m benchmarks.room_memory --rooms 1000
+    python -m benchmarks.room_memory --redis-url redis://localhost:6379/15
+
+Against a real Redis the totals come from MEMORY USAGE, which includes each key's encoding and overhead.
+fakeredis has no MEMORY USAGE, so only the payload (key, field and value bytes) is reported there.
+Results are compared with benchmarks/baselines.json like benchmarks.game_load.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+from collections import defaultdict
+
+from benchmarks.game_load import BASELINES, configure
+
+COMPARED = ["keys_per_room", "payload_bytes_per_room", "memory_bytes_per_room"]
+SCALE = 100_000
+
+
+def kind(key: str):
+    """Groups keys by what they hold: room:{<id>}:events -> room:events, assigned:{pool:0}:<bucket> -> assigned."""
+    head, _, rest = key.partition(":")
+    if head == "room":
+        return "room" + rest.partition("}")[2]
+    return head
+
+
+async def payload(client, key: bytes):
+    key_type = (await client.type(key)).decode()
+    if key_type == "string":
+        return len(key) + len(await client.get(key))
+    if key_type == "hash":
+        return len(key) + sum(len(field) + len(value) for field, value in (await client.hgetall(key)).items())
+    if key_type == "list":
+        return len(key) + sum(len(item) for item in await client.lrange(key, 0, -1))
+    if key_type == "set":
+        return len(key) + sum(len(member) for member in await client.smembers(key))
+    if key_type == "zset":
+        return len(key) + sum(len(member) + 8 for member, _ in await client.zrange(key, 0, -1, withscores=True))
+    if key_type == "stream":
+        entries = await client.xrange(key)
+        return len(key) + sum(
+            len(entry_id) + sum(len(field) + len(value) for field, value in fields.items()) for entry_id, fields in entries
+        )
+    return len(key)
+
+
+async def measure(client):
+    by_kind = defaultdict(lambda: {"keys": 0, "payload_bytes": 0, "memory_bytes": 0})
+    memory_usage = True
+    async for key in client.scan_iter(count=1000):
+        group = by_kind[kind(key.decode())]
+        group["keys"] += 1
+        group["payload_bytes"] += await payload(client, key)
+        if memory_usage:
+            try:
+                group["memory_bytes"] += await client.memory_usage(key, samples=0) or 0
+            except Exception:
+                memory_usage = False
+    if not memory_usage:
+        for group in by_kind.values():
+            group["memory_bytes"] = None
+    return dict(sorted(by_kind.items())), memory_usage
+
+
+async def fill_rooms(rooms: int, size: int):
+    from app.core.config import get_settings
+    from app.services.game import add_user_to_pool, create_room, connect_player, submit_turn, cast_vote
+    from app.services.room_cache import room_cache
+
+    settings = get_settings()
+    for room in range(rooms):
+        # Realistic name lengths rather than the shortest possible ones.
+        for seat in range(size):
+            await add_user_to_pool(f"player_{room}_{seat}")
+    created = []
+    for shard in range(settings.MATCHMAKING_SHARDS):
+        while (room_id := await create_room(shard, size)) is not None:
+            created.append(room_id)
+    for room_id in created:
+        state = await room_cache.get(room_id)
+        for index in range(len(state.players)):
+            await connect_player(room_id, index)
+        for username in state.users:
+            await submit_turn(room_id, username, "Is it somewhere you would go on holiday?", "Only if someone else paid")
+        for username in state.users[:-1]:
+            await cast_vote(room_id, username, random.choice([user for user in state.users if user != username]))
+        room_cache.invalidate(room_id)
+    return len(created)
+
+
+async def main(args):
+    client = configure(argparse.Namespace(
+        database_url=None, redis_url=args.redis_url, backend="redis", clients=1, verbose=False
+    ))
+    import app.core.config as config
+    config.get_settings().MIN_ROOM_SIZE = args.room_size
+    config.get_settings().MAX_ROOM_SIZE = args.room_size
+    random.seed(0)
+    rooms = await fill_rooms(args.rooms, args.room_size)
+    by_kind, memory_usage = await measure(client)
+    keys = sum(group["keys"] for group in by_kind.values())
+    payload_bytes = sum(group["payload_bytes"] for group in by_kind.values())
+    memory_bytes = sum(group["memory_bytes"] for group in by_kind.values()) if memory_usage else None
+    per_room = lambda total: round(total / rooms, 1) if total is not None and rooms else None
+    per_scale = lambda total: round(total / rooms * SCALE / 2**20, 1) if total is not None and rooms else None
+    return {
+        "rooms": rooms,
+        "room_size": args.room_size,
+        "keys_per_room": per_room(keys),
+        "payload_bytes_per_room": per_room(payload_bytes),
+        "memory_bytes_per_room": per_room(memory_bytes),
+        "payload_mb_per_100k_rooms": per_scale(payload_bytes),
+        "memory_mb_per_100k_rooms": per_scale(memory_bytes),
+        "by_kind": {
+            name: {metric: per_room(value) for metric, value in group.items()} for name, group in by_kind.items()
+        },
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=6)
+    parser.add_argument("--redis-url", help="real Redis to use instead of fakeredis; use an empty database")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="allowed relative growth per metric")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--no-compare", action="store_true")
+    args = parser.parse_args()
+    scenario = f"room-memory-{'redis' if args.redis_url else 'fakeredis'}-{args.rooms}x{args.room_size}"
+
+    result = asyncio.run(main(args))
+    print(json.dumps({scenario: result}, indent=2))
+
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    if args.save_baseline:
+        baselines[scenario] = result
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Saved baseline {scenario}", file=sys.stderr)
+    elif not args.no_compare and scenario in baselines:
+        regressions = []
+        for metric in COMPARED:
+            current, previous = result.get(metric), baselines[scenario].get(metric)
+            if current is not None and previous and (current - previous) / previous > args.tolerance:
+                regressions.append(f"{metric}: {previous} -> {current} ({(current - previous) / previous:+.0%})")
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
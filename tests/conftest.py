@@ -0,0 +1,18 @@
+"""The tests run against fakeredis and a temporary SQLite file, like benchmarks.game_load without --redis-url.
+Settings are read once at import, so the environment and the Redis client have to be in place before the app
+is loaded. STATE_BACKEND=owned loads the local timer scheduler that OwnedGameStore needs; the tests build every
+store they use themselves. With REDIS_CLUSTER_TEST_URL set only the cluster tests run, against that cluster."""
+import os
+import tempfile
+
+if not os.environ.get("REDIS_CLUSTER_TEST_URL"):
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///" + os.path.join(tempfile.mkdtemp(prefix="game-tests-"), "test.db")
+    os.environ["STATE_BACKEND"] = "owned"
+    # fakeredis does not answer the health-check PING the real pool sends before reusing a connection.
+    os.environ["REDIS_HEALTH_CHECK_INTERVAL"] = "0"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    import fakeredis
+    import app.redis as app_redis
+
+    app_redis.redis_client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
@@ -0,0 +1,68 @@
+"""Cluster mode against a live Redis Cluster; skipped unless one is given:
+
+    REDIS_CLUSTER_TEST_URL=redis://localhost:7000 python -m pytest tests/test_cluster.py
+
+The test keys are deleted afterwards, but use a throwaway cluster all the same.
+"""
+import asyncio
+import os
+from uuid import uuid4
+import pytest
+
+CLUSTER_URL = os.environ.get("REDIS_CLUSTER_TEST_URL")
+if not CLUSTER_URL:
+    pytest.skip("REDIS_CLUSTER_TEST_URL is not set", allow_module_level=True)
+
+# Settings are read once at import, so the environment has to be in place before the app is loaded.
+os.environ["REDIS_URL"] = CLUSTER_URL
+os.environ["REDIS_CLUSTER"] = "true"
+os.environ["STATE_BACKEND"] = "redis"
+
+import pytest_asyncio  # noqa: E402
+from app.core.keys import pool_key, shard_of, user_channel, wakeup_channel  # noqa: E402
+from app.redis import redis_client  # noqa: E402
+from app.services.pubsub import hub  # noqa: E402
+from app.services.store import store  # noqa: E402
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def cluster():
+    yield
+    # Every test runs on its own loop; the connections must not outlive it.
+    await hub.stop()
+    await redis_client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_join_pool_queues_the_player_and_wakes_their_shard():
+    username = f"cluster-test-{uuid4().hex}"
+    shard = shard_of(username)
+    try:
+        async with hub.waiter(wakeup_channel(shard)) as woken:
+            await store.join_pool(username)
+            await asyncio.wait_for(woken, 5)
+        assert await redis_client.zscore(pool_key(shard), username) is not None
+    finally:
+        await redis_client.zrem(pool_key(shard), username)
+
+
+@pytest.mark.asyncio
+async def test_hub_publish_reaches_shard_channels_on_every_node():
+    # Enough channels that they hash to slots on more than one node.
+    channels = [user_channel(f"cluster-test-{uuid4().hex}") for _ in range(16)]
+    received = {}
+
+    def handler(channel):
+        return lambda frame: received.setdefault(channel, frame.data)
+
+    handlers = {channel: handler(channel) for channel in channels}
+    for channel, on_message in handlers.items():
+        await hub.subscribe(channel, on_message)
+    await hub.publish(*((channel, f'{{"channel":"{channel}"}}') for channel in channels))
+    for _ in range(50):
+        if len(received) == len(channels):
+            break
+        await asyncio.sleep(0.1)
+    assert received == {channel: {"channel": channel} for channel in channels}
+    for channel, on_message in handlers.items():
+        await hub.unsubscribe(channel, on_message)
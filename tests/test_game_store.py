@@ -0,0 +1,301 @@
+"""The game store's room state machine, the same for every backend: the Lua scripts in app.services.scripts
+behind RedisGameStore, and LocalRooms behind MemoryGameStore and OwnedGameStore. Rooms handed from one
+OwnedGameStore to another through their snapshots play on where they left off."""
+import asyncio
+import os
+import time
+import pytest
+
+if os.environ.get("REDIS_CLUSTER_TEST_URL"):
+    pytest.skip("runs against fakeredis; run the cluster tests on their own", allow_module_level=True)
+
+import pytest_asyncio  # noqa: E402
+from app.redis import redis_client  # noqa: E402
+from app.services.store import RedisGameStore  # noqa: E402
+from app.services.memory_store import MemoryGameStore  # noqa: E402
+from app.services.owned_store import OwnedGameStore  # noqa: E402
+from app.services.timers import timers  # noqa: E402
+import app.services.game  # noqa: E402,F401  registers the timer kinds a snapshot carries
+
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+PLAYERS = ["ann", "bob", "cid", "dee", "eve"]
+ROOM = "room-1"
+
+
+STORES = {
+    "redis": lambda: RedisGameStore(redis_client),
+    "memory": MemoryGameStore,
+    "owned": lambda: OwnedGameStore(redis_client),
+}
+
+
+@pytest_asyncio.fixture(loop_scope="session", params=list(STORES))
+async def store(request):
+    await redis_client.flushall()
+    return STORES[request.param]()
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def owners():
+    """Two workers of STATE_BACKEND=owned; the room starts out with the first."""
+    await redis_client.flushall()
+    yield OwnedGameStore(redis_client), OwnedGameStore(redis_client)
+    await timers.cancel(ROOM)
+
+
+async def new_room(store, players=PLAYERS, spy=0):
+    await store.create_room(ROOM, 0, list(players), spy, "Paris", time.time())
+
+
+async def play_round(store, players):
+    """Every player still in takes their turn; the room is voting afterwards."""
+    for turn, player in enumerate(players):
+        result = await store.advance_turn(ROOM, None, player, f"q{turn}", f"a{turn}")
+        assert result[0] == ("voting" if turn == len(players) - 1 else "turn")
+
+
+async def vote(store, ballot):
+    """Casts {voter: voted_for} in order; returns the last result."""
+    result = None
+    for voter, voted_for in ballot.items():
+        result = await store.cast_vote(ROOM, voter, voted_for)
+    return result
+
+
+async def test_claim_players_takes_the_longest_waiting(store):
+    for player in PLAYERS:
+        await store.join_pool(player)
+        await asyncio.sleep(0.001)
+    players, joined_at = await store.claim_players(0, ROOM, 3)
+    assert players == PLAYERS[:3]
+    assert joined_at == sorted(joined_at)
+    assert await store.assigned_room("bob") == ROOM
+    assert await store.pool_size(0) == 2
+
+
+async def test_claim_players_puts_back_too_few_keeping_their_place(store):
+    for player in PLAYERS[:3]:
+        await store.join_pool(player)
+    await store.claim_players(0, ROOM, 3)
+    # ann joins again while she holds a room: she is skipped, which leaves too few for a room.
+    for player in ["ann", "dee", "eve"]:
+        await store.join_pool(player)
+        await asyncio.sleep(0.001)
+    joined_at = [(await store.queue_position(player))[1] for player in ["dee", "eve"]]
+    assert await store.claim_players(0, "room-2", 3) is None
+    assert await store.pool_size(0) == 2
+    assert [(await store.queue_position(player))[:2] for player in ["dee", "eve"]] == list(zip([0, 1], joined_at))
+    assert await store.assigned_room("dee") is None
+
+
+async def test_turns_advance_in_order(store):
+    await new_room(store)
+    assert await store.advance_turn(ROOM, None, "bob", "q", "a") is None
+    assert await store.advance_turn(ROOM, None, "ann", "q0", "a0") == ("turn", 1, PLAYERS, "q0")
+    assert await store.turn_state(ROOM) == ("active", PLAYERS, "q0")
+
+
+async def test_stale_expected_turn_is_ignored(store):
+    await new_room(store)
+    await store.advance_turn(ROOM, None, "ann", "q0", "a0")
+    # The timer for turn 0 fires after ann already answered.
+    assert await store.advance_turn(ROOM, 0, "", "", "") is None
+    assert (await store.room_state(ROOM))[1] == 1
+
+
+async def test_timed_out_turn_passes_without_a_question(store):
+    await new_room(store)
+    assert await store.advance_turn(ROOM, 0, "", "", "") == ("turn", 1, PLAYERS, None)
+    assert await store.previous_question(ROOM) is None
+    assert await store.advance_turn(ROOM, None, "bob", "q1", "a1") == ("turn", 2, PLAYERS, "q1")
+
+
+async def test_last_turn_starts_voting(store):
+    await new_room(store, PLAYERS[:3])
+    await play_round(store, PLAYERS[:3])
+    assert (await store.room_state(ROOM))[0] == "voting"
+    assert await store.advance_turn(ROOM, None, "ann", "q", "a") is None
+
+
+async def test_tie_then_revote(store):
+    players = PLAYERS[:4]
+    await new_room(store, players)
+    await play_round(store, players)
+    result = await vote(store, {"ann": "bob", "bob": "ann", "cid": "bob", "dee": "ann"})
+    assert result == ("cast", "tie", (1, 1, [("ann", "bob"), ("bob", "ann"), ("cid", "bob"), ("dee", "ann")], None))
+    assert (await store.room_state(ROOM))[0] == "voting"
+    # The tie cleared the ballot: one vote is not enough to decide.
+    assert await store.cast_vote(ROOM, "ann", "cid") == ("cast",)
+    kind, spy, voted, remaining, record = (await vote(store, {"bob": "cid", "cid": "dee", "dee": "cid"}))[1:]
+    assert (kind, spy, voted, remaining) == ("eliminated", "ann", "cid", 3)
+    round, ballot, votes, questions = record
+    assert (round, ballot) == (1, 2)
+    assert votes == [("ann", "cid"), ("bob", "cid"), ("cid", "dee"), ("dee", "cid")]
+    assert [question["player"] for question in questions] == players
+
+
+async def test_eliminating_a_player_with_more_than_two_left_starts_a_new_round(store):
+    await new_room(store, PLAYERS[:4])
+    await play_round(store, PLAYERS[:4])
+    result = await vote(store, {"ann": "dee", "bob": "dee", "cid": "dee", "dee": "ann"})
+    assert result[1:5] == ("eliminated", "ann", "dee", 3)
+    assert await store.room_state(ROOM) == ("active", 0, PLAYERS[:4], PLAYERS[:3], "ann", "Paris")
+    # The next round starts with no questions and a fresh ballot number.
+    assert await store.previous_question(ROOM) is None
+    await play_round(store, PLAYERS[:3])
+    result = await vote(store, {"ann": "bob", "bob": "cid", "cid": "bob"})
+    assert result[1:5] == ("eliminated", "ann", "bob", 2)
+    assert result[5][:2] == (2, 1)
+
+
+async def test_eliminating_a_player_with_two_left_ends_the_game(store):
+    await new_room(store, PLAYERS[:3], spy=2)
+    await play_round(store, PLAYERS[:3])
+    result = await vote(store, {"ann": "bob", "bob": "cid", "cid": "bob"})
+    assert result[1:5] == ("eliminated", "cid", "bob", 2)
+    assert (await store.room_state(ROOM))[0] == "ended"
+
+
+async def test_voting_out_the_spy(store):
+    await new_room(store, PLAYERS[:3], spy=1)
+    await play_round(store, PLAYERS[:3])
+    result = await vote(store, {"ann": "bob", "bob": "ann", "cid": "bob"})
+    assert result[1:3] == ("players_win", "bob")
+    assert (await store.room_state(ROOM))[0] == "ended"
+
+
+async def test_eliminated_player_cannot_vote(store):
+    await new_room(store, PLAYERS[:4])
+    await play_round(store, PLAYERS[:4])
+    await vote(store, {"ann": "dee", "bob": "dee", "cid": "dee", "dee": "ann"})
+    await play_round(store, PLAYERS[:3])
+    assert await store.cast_vote(ROOM, "dee", "ann") is None
+    assert await store.cast_vote(ROOM, "stranger", "ann") is None
+    assert await store.cast_vote(ROOM, "ann", "bob") == ("cast",)
+
+
+async def test_vote_for_nobody_counts_as_cast(store):
+    await new_room(store, PLAYERS[:3])
+    await play_round(store, PLAYERS[:3])
+    result = await vote(store, {"ann": "bob", "bob": "nobody", "cid": "bob"})
+    assert result[1:4] == ("eliminated", "ann", "bob")
+    assert result[5][2] == [("ann", "bob"), ("bob", None), ("cid", "bob")]
+
+
+async def test_voting_timeout_tallies_the_partial_ballot(store):
+    await new_room(store, PLAYERS[:4])
+    await play_round(store, PLAYERS[:4])
+    await vote(store, {"ann": "cid", "bob": "cid"})
+    result = await store.process_votes(ROOM)
+    assert result[:4] == ("eliminated", "ann", "cid", 3)
+    assert result[4][2] == [("ann", "cid"), ("bob", "cid")]
+    # Nothing left to tally once the room is active again.
+    assert await store.process_votes(ROOM) is None
+
+
+async def test_voting_timeout_without_votes_is_a_tie(store):
+    await new_room(store, PLAYERS[:3])
+    await play_round(store, PLAYERS[:3])
+    assert await store.process_votes(ROOM) == ("tie", (1, 1, [], None))
+    assert await store.process_votes(ROOM) == ("tie", (1, 2, [], None))
+
+
+async def test_concurrent_final_votes_tally_once(store):
+    players = PLAYERS[:4]
+    await new_room(store, players)
+    await play_round(store, players)
+    await vote(store, {"ann": "dee", "bob": "dee"})
+    results = await asyncio.gather(store.cast_vote(ROOM, "cid", "dee"), store.cast_vote(ROOM, "dee", "ann"))
+    tallied = [result for result in results if len(result) > 1]
+    assert len(tallied) == 1
+    assert tallied[0][1:5] == ("eliminated", "ann", "dee", 3)
+    assert tallied[0][5][2] == [("ann", "dee"), ("bob", "dee"), ("cid", "dee"), ("dee", "ann")]
+    assert (await store.room_state(ROOM))[0] == "active"
+
+
+async def test_leaving_on_your_turn_hands_it_to_the_next_player(store):
+    await new_room(store)
+    await store.advance_turn(ROOM, None, "ann", "q0", "a0")
+    assert await store.leave_room(ROOM, "bob") == 4
+    remaining = ["ann", "cid", "dee", "eve"]
+    assert await store.room_state(ROOM) == ("active", 1, PLAYERS, remaining, "ann", "Paris")
+    assert await store.advance_turn(ROOM, None, "cid", "q1", "a1") == ("turn", 2, remaining, "q1")
+    assert await store.leave_room(ROOM, "bob") is None
+
+
+async def test_last_player_leaving_on_their_turn_wraps_it_around(store):
+    await new_room(store, PLAYERS[:4])
+    for turn, player in enumerate(PLAYERS[:3]):
+        await store.advance_turn(ROOM, None, player, f"q{turn}", f"a{turn}")
+    assert await store.leave_room(ROOM, "dee") == 3
+    assert (await store.room_state(ROOM))[1] == 0
+
+
+async def test_end_game_only_from_the_given_statuses(store):
+    await new_room(store, PLAYERS[:3], spy=1)
+    await play_round(store, PLAYERS[:3])
+    assert await store.end_game(ROOM, "active") is None
+    assert await store.end_game(ROOM, "active", "voting") == "bob"
+    assert await store.end_game(ROOM, "active", "voting") is None
+    assert await store.cast_vote(ROOM, "ann", "bob") is None
+
+
+async def test_close_room_returns_the_game(store):
+    await new_room(store, PLAYERS[:3])
+    await store.advance_turn(ROOM, None, "ann", "q0", "a0")
+    game = await store.close_room(ROOM)
+    assert game["players"] == PLAYERS[:3]
+    assert game["alive"] == PLAYERS[:3]
+    assert (game["spy"], game["secret_location"], game["round"]) == ("ann", "Paris", 1)
+    assert game["questions"] == [{"player": "ann", "answer": "a0", "question": "q0"}]
+    assert not await store.room_exists(ROOM)
+    assert await store.close_room(ROOM) is None
+
+
+async def test_taken_over_room_plays_on_from_its_snapshot(owners):
+    first, second = owners
+    players = PLAYERS[:4]
+    await new_room(first, players)
+    await first.connect(ROOM, 2)
+    await first.start_game(ROOM)
+    await play_round(first, players)
+    await vote(first, {"ann": "bob", "bob": "ann", "cid": "bob", "dee": "ann"})
+    await first.cast_vote(ROOM, "ann", "cid")
+    assert await first.save_snapshots() == []
+    state = await first.room_state(ROOM)
+
+    assert not await second.take_over(ROOM, second.token)
+    assert await second.take_over(ROOM, first.token)
+    assert await second.owner_of(ROOM) == second.token
+    assert await second.room_state(ROOM) == state
+    assert not await second.start_game(ROOM)
+    assert await second.connect(ROOM, 3) == 2
+    result = await vote(second, {"bob": "cid", "cid": "dee", "dee": "cid"})
+    assert result[1:5] == ("eliminated", "ann", "cid", 3)
+    assert result[5][:3] == (1, 2, [("ann", "cid"), ("bob", "cid"), ("cid", "dee"), ("dee", "cid")])
+    assert [question["player"] for question in result[5][3]] == players
+
+    # The first worker finds out at its next save and lets the room go.
+    await first.cast_vote(ROOM, "bob", "dee")
+    assert await first.save_snapshots() == [ROOM]
+    assert second.owns(ROOM)
+
+
+async def test_adopting_the_rooms_of_a_worker_that_is_gone_restores_their_timers(owners):
+    gone, adopter = owners
+    await new_room(gone)
+    await timers.schedule("turn", ROOM, 60, turn_index=1)
+    await gone.advance_turn(ROOM, None, "ann", "q0", "a0")
+    await gone.save_snapshots()
+    [(kind, due, args)] = timers.pending(ROOM)
+    await timers.cancel(ROOM)
+
+    assert set(await adopter.room_workers()) == {gone.token}
+    assert await adopter.adopt(gone.token) == 1
+    assert await adopter.room_state(ROOM) == ("active", 1, PLAYERS, PLAYERS, "ann", "Paris")
+    [(kind_, due_, args_)] = timers.pending(ROOM)
+    assert (kind_, args_) == (kind, args)
+    assert due_ == pytest.approx(due, abs=1)
+    assert set(await adopter.room_workers()) == {adopter.token}
+    assert await adopter.adopt(gone.token) == 0